@@ -16,6 +16,9 @@ class __Config:
     def __setitem__(self, key, value):
         self.config[key] = value
 
+    def get(self, item, default=None):
+        return self.config.get(item, default)
+
 
 MAIN_CFG = __Config(__file__[:-3] + ".toml")
 
@@ -3,14 +3,18 @@ import os
 import traceback
 from tkinter import Tk
 from tkinter.filedialog import askopenfilename
-from typing import Optional, Union
+from typing import Optional, Union, List
 
 import config
 from config import MAIN_CFG
 from reader.KanjiInfoReader import KanjiReader
+from reader.analysis_cache import AnalysisCache
 from reader.ichiran_reader import IchiranReader
+from reader.preanalysis import SubtitlePreanalyzer
+from reader.subtitle_alignment import SubtitleAlignment
+from reader.subtitle_cache import SubtitleCache
 from reader.subtitle_reader import GenericReader, SubtitleEvent, align, MasterReader
-from reader.video_reader import VideoReader
+from reader.video_reader import VideoReader, AudioProfile, ImageProfile
 from utils import parse_timestamp
 from writer.ankiwriter import AnkiWriter
 
@@ -23,8 +27,11 @@ def read_timestamp(stamp: str) -> float:
 
 def sub_chooser(sub_reader: GenericReader, timestamp: Union[SubtitleEvent, float], max_to_print: int = 10,
                 auto_choice: bool = True) -> Optional[SubtitleEvent]:
-    all_events = sub_reader.get_all_lines_and_time_ranges(timestamp)
+    return events_chooser(sub_reader.get_all_lines_and_time_ranges(timestamp), max_to_print, auto_choice)
 
+
+def events_chooser(all_events: List[SubtitleEvent], max_to_print: int = 10,
+                   auto_choice: bool = True) -> Optional[SubtitleEvent]:
     if len(all_events) == 1 and auto_choice:
         print("Only one event at timestamp, choosing it:")
         print(str(all_events[0]))
@@ -143,13 +150,25 @@ if __name__ == "__main__":
     print("Updated memory for chose video file!")
     dump_mem(memory)
 
-    vid_reader = VideoReader(vid_file)
-    sub_reader_eng = MasterReader(sub_file_eng)
-    sub_reader_jp = MasterReader(sub_file_jp)
-    ichi_reader = IchiranReader()
-    kanji_reader = KanjiReader()
+    vid_reader = VideoReader(vid_file,
+                             audio_profile=AudioProfile.from_config(MAIN_CFG.get("audio", {})),
+                             image_profile=ImageProfile.from_config(MAIN_CFG.get("image", {})),
+                             index_dir=os.path.join(MAIN_CFG.data_path, "keyframe_index"))
+    sub_cache = SubtitleCache(os.path.join(MAIN_CFG.data_path, "subtitle_cache"))
+    sub_reader_eng = MasterReader(sub_file_eng, cache=sub_cache)
+    sub_reader_jp = MasterReader(sub_file_jp, cache=sub_cache)
+    sub_alignment = SubtitleAlignment(sub_reader_jp, sub_reader_eng)
+    ichi_cache = AnalysisCache(cache_dir=os.path.join(MAIN_CFG.data_path, "ichiran_cache"))
+    ichi_reader = IchiranReader(cache=ichi_cache)
+    kanji_reader = KanjiReader(snapshot_path=os.path.join(MAIN_CFG.data_path, "kanji_meanings.json"))
     writer = AnkiWriter(MAIN_CFG["collection"],
-                        MAIN_CFG["main_deck"])
+                        MAIN_CFG["main_deck"],
+                        media_index_path=os.path.join(MAIN_CFG.data_path, "media_index.json"))
+    preanalyzer = None
+    if MAIN_CFG.get("preanalyze", False):
+        preanalyzer = SubtitlePreanalyzer(ichi_reader, sub_reader_jp, max_workers=MAIN_CFG.get("preanalyze_workers", 2))
+        preanalyzer.start()
+        print("Started analyzing the japanese subtitles in the background")
     print("All ready!")
 
     mined_this_session = 0
@@ -165,12 +184,22 @@ if __name__ == "__main__":
                     print("Thank you for using the cmd miner :)")
                     print(f"Mined {mined_this_session} cards this session!")
                     vid_reader.clear_everything()
+                    if preanalyzer is not None:
+                        preanalyzer.stop()
                     exit(0)
                 else:
                     continue
             elif 'help'.startswith(cmd.lower()):
                 print("[q]uit - exit the program")
                 print("[h]elp - show this text")
+                print("[p]rogress - show the progress of the background subtitle analysis")
+                continue
+            elif 'progress'.startswith(cmd.lower()):
+                if preanalyzer is None:
+                    print("Background analysis is off, set preanalyze in the config to turn it on")
+                else:
+                    progress = preanalyzer.progress()
+                    print(f"Analyzed {progress['done']}/{progress['total']} lines ({progress['failed']} failed)")
                 continue
             timestamp = read_timestamp(cmd)
 
@@ -180,7 +209,7 @@ if __name__ == "__main__":
 
             print(ichi_reader.to_deconstruction(jp_sub.text))
 
-            eng_sub = sub_chooser(sub_reader_eng, jp_sub, auto_choice=False)
+            eng_sub = events_chooser([match.event for match in sub_alignment.matches(jp_sub)], auto_choice=False)
             if eng_sub is None:
                 print("No english sub chosen. Enter manually")
                 eng_sub = input(" >>> ")
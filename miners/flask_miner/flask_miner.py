@@ -1,16 +1,22 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor, wait
 from tkinter.filedialog import askopenfilename
-from typing import Optional
+from typing import Optional, Dict, Callable, Any, Tuple
 
 from flask import Flask, render_template, request, jsonify, redirect
 
 import config
 from miners.cmd_miner import load_memory, dump_mem, read_timestamp
 from reader.KanjiInfoReader import KanjiReader
+from reader.analysis_cache import AnalysisCache
+from reader.asset_prefetch import AssetPrefetcher
 from reader.ichiran_reader import IchiranReader
+from reader.preanalysis import SubtitlePreanalyzer
+from reader.subtitle_alignment import SubtitleAlignment
+from reader.subtitle_cache import SubtitleCache
 from reader.subtitle_reader import MasterReader
-from reader.video_reader import VideoReader
+from reader.video_reader import VideoReader, AudioProfile, ImageProfile
 from writer.ankiwriter import AnkiWriter
 
 app = Flask(__name__)
@@ -19,28 +25,57 @@ app = Flask(__name__)
 vid_reader: Optional[VideoReader] = None
 sub_reader_jp: Optional[MasterReader] = None
 sub_reader_eng: Optional[MasterReader] = None
+sub_alignment: Optional[SubtitleAlignment] = None
 ichi_reader: Optional[IchiranReader] = None
 kanji_reader: Optional[KanjiReader] = None
 anki_writer: Optional[AnkiWriter] = None
+preanalyzer: Optional[SubtitlePreanalyzer] = None
+prefetcher: Optional[AssetPrefetcher] = None
+# Prepares the assets of a card in /mine concurrently
+mine_executor = ThreadPoolExecutor(max_workers=4)
+# Prefetching has its own threads, the steps of /mine wait for prefetched assets and mustn't wait for their own pool
+prefetch_executor = ThreadPoolExecutor(max_workers=2)
 
 
 # Initialize the necessary objects using the selected files
 def initialize(video_file, jp_sub_file, eng_sub_file):
-    global vid_reader, sub_reader_jp, sub_reader_eng, ichi_reader, kanji_reader, anki_writer
-    vid_reader = VideoReader(video_file, save_loc=os.path.join(os.path.dirname(__file__), 'static', 'mined'))
-    sub_reader_jp = MasterReader(jp_sub_file)
-    sub_reader_eng = MasterReader(eng_sub_file)
-    ichi_reader = IchiranReader()
-    kanji_reader = KanjiReader()
-    anki_writer = AnkiWriter(config.MAIN_CFG["collection"], config.MAIN_CFG["main_deck"])
+    global vid_reader, sub_reader_jp, sub_reader_eng, sub_alignment, ichi_reader, kanji_reader, anki_writer, \
+        preanalyzer, prefetcher
+    vid_reader = VideoReader(video_file, save_loc=os.path.join(os.path.dirname(__file__), 'static', 'mined'),
+                             audio_profile=AudioProfile.from_config(config.MAIN_CFG.get("audio", {})),
+                             image_profile=ImageProfile.from_config(config.MAIN_CFG.get("image", {})),
+                             index_dir=os.path.join(config.MAIN_CFG.data_path, "keyframe_index"))
+    sub_cache = SubtitleCache(os.path.join(config.MAIN_CFG.data_path, "subtitle_cache"))
+    sub_reader_jp = MasterReader(jp_sub_file, cache=sub_cache)
+    sub_reader_eng = MasterReader(eng_sub_file, cache=sub_cache)
+    sub_alignment = SubtitleAlignment(sub_reader_jp, sub_reader_eng)
+    ichi_cache = AnalysisCache(cache_dir=os.path.join(config.MAIN_CFG.data_path, "ichiran_cache"))
+    ichi_reader = IchiranReader(cache=ichi_cache)
+    kanji_reader = KanjiReader(snapshot_path=os.path.join(config.MAIN_CFG.data_path, "kanji_meanings.json"))
+    anki_writer = AnkiWriter(config.MAIN_CFG["collection"], config.MAIN_CFG["main_deck"],
+                             media_index_path=os.path.join(config.MAIN_CFG.data_path, "media_index.json"))
+    prefetcher = AssetPrefetcher(vid_reader, ichi_reader, prefetch_executor,
+                                 max_entries=config.MAIN_CFG.get("prefetch_entries", 32))
+    if config.MAIN_CFG.get("preanalyze", False):
+        preanalyzer = SubtitlePreanalyzer(ichi_reader, sub_reader_jp,
+                                          max_workers=config.MAIN_CFG.get("preanalyze_workers", 2))
+        preanalyzer.start()
 
 
 @app.route('/')
 def index():
+    prefetcher.clear()
     vid_reader.clear_everything()
     return render_template('index.html')
 
 
+@app.route('/preanalysis_progress', methods=['GET'])
+def preanalysis_progress():
+    if preanalyzer is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, **preanalyzer.progress())
+
+
 @app.errorhandler(405)
 def method_not_allowed(e):
     return redirect('/')
@@ -51,14 +86,15 @@ def select_timestamp():
     timestamp = request.form.get('timestamp')
 
     jp_sub = sub_reader_jp.get_all_lines_and_time_ranges(read_timestamp(timestamp))
+    # One of these lines is probably about to be mined
+    prefetcher.prefetch(jp_sub, read_timestamp(timestamp))
     eng_sub = []
-    added_eng_text = []
+    added_eng_text = set()
     for sub in jp_sub:
-        new_subs = sub_reader_eng.get_all_lines_and_time_ranges(sub)
-        for new_sub in new_subs:
-            if new_sub.text not in added_eng_text:
-                eng_sub.append(new_sub)
-                added_eng_text.append(new_sub.text)
+        for match in sub_alignment.matches(sub):
+            if match.event.text not in added_eng_text:
+                eng_sub.append(match.event)
+                added_eng_text.add(match.event.text)
 
     return render_template('select_subs.html', jp_subs=jp_sub, eng_subs=eng_sub,
                            timestamp=timestamp)
@@ -69,7 +105,7 @@ def get_decomposition():
     jp_sub = request.args.get('jp_sub', '')
     try:
         return jsonify(decomposition=ichi_reader.to_deconstruction(jp_sub))
-    except RuntimeError as e:
+    except (RuntimeError, ValueError) as e:
         return jsonify(decomposition=f'got error {e} while getting decomposition for {jp_sub}!')
 
 
@@ -104,17 +140,55 @@ def deconstruction_json_to_wordlist(decon):
     return rt
 
 
+@app.route('/analyze', methods=['GET'])
+def analyze():
+    jp_sub = request.args.get('jp_sub', '')
+    try:
+        analysis = ichi_reader.analyze(jp_sub)
+        response = jsonify(decomposition=ichi_reader.analysis_to_deconstruction(analysis),
+                           wordlist=deconstruction_json_to_wordlist(analysis))
+    except (RuntimeError, ValueError) as e:
+        return jsonify(decomposition=f'got error {e} while analyzing {jp_sub}!', wordlist=[])
+
+    # The analysis of a text doesn't change, so the browser can keep it
+    response.set_etag(ichi_reader.cache.key('-f', jp_sub))
+    response.cache_control.private = True
+    response.cache_control.max_age = 24 * 60 * 60
+    return response.make_conditional(request)
+
+
 @app.route('/get_wordlist', methods=['GET'])
 def get_wordlist():
     jp_sub = request.args.get('jp_sub', '')
     try:
-        js_deconstruction = json.loads(ichi_reader.run_ichiran_cmd(flags='-f', text=jp_sub))
+        js_deconstruction = ichi_reader.analyze(jp_sub)
         # print(json.dumps(js_deconstruction, indent=1))
         return jsonify(deconstruction_json_to_wordlist(js_deconstruction))
     except RuntimeError as e:
         return jsonify([])
 
 
+def run_steps(steps: Dict[str, Callable[[], Any]], timeout: float) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Runs independent steps concurrently on `mine_executor`, waiting at most `timeout` seconds for all of them.
+    :return: The results of the steps that finished, and an error message for every step that failed or timed out.
+    """
+    futures = {name: mine_executor.submit(step) for name, step in steps.items()}
+    done, _ = wait(futures.values(), timeout=timeout)
+    results = dict()
+    errors = dict()
+    for name, future in futures.items():
+        if future not in done:
+            # A step that already started can't be stopped, it finishes in the background
+            future.cancel()
+            errors[name] = f"didn't finish within {timeout} seconds"
+        elif future.exception() is not None:
+            errors[name] = f"{type(future.exception()).__name__}: {future.exception()}"
+        else:
+            results[name] = future.result()
+    return results, errors
+
+
 @app.route('/mine', methods=['POST'])
 def mine_card():
     jp_sub = json.loads(request.form.get('jp_sub'))
@@ -125,11 +199,22 @@ def mine_card():
     definition = request.form.get('definition')
     timestamp = read_timestamp(request.form.get('timestamp'))
 
-    image = vid_reader.extract_image(timestamp)
-    audio = vid_reader.extract_audio(jp_sub['t0'], jp_sub['t1'])
-    furigana = ichi_reader.to_furigana(jp_sub['text'])
-
-    kanji_pairs = kanji_reader.extract_kanji_meaning_pairs(word['text'])
+    results, errors = run_steps({
+        "screenshot": lambda: prefetcher.get((VideoReader.IMAGE, timestamp, timestamp),
+                                             lambda: vid_reader.extract_image(timestamp)),
+        "audio": lambda: prefetcher.get((VideoReader.AUDIO, jp_sub['t0'], jp_sub['t1']),
+                                        lambda: vid_reader.extract_audio(jp_sub['t0'], jp_sub['t1'])),
+        "furigana": lambda: prefetcher.get((AssetPrefetcher.FURIGANA, jp_sub['text']),
+                                           lambda: ichi_reader.to_furigana(jp_sub['text'])),
+        "kanji": lambda: kanji_reader.extract_kanji_meaning_pairs(word['text']),
+    }, timeout=config.MAIN_CFG.get("mine_timeout", 60.0))
+    if len(errors) != 0:
+        return render_template('mine_error.html', target=word['text'], errors=errors), 500
+
+    image = results["screenshot"]
+    audio = results["audio"]
+    furigana = results["furigana"]
+    kanji_pairs = results["kanji"]
     if len(kanji_pairs) < 4:
         for i in range(4 - len(kanji_pairs)):
             kanji_pairs.append(("", ""))
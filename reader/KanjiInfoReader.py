@@ -1,27 +1,65 @@
-import re
+import json
+import os
+from typing import Dict, Optional
 
 from config import MAIN_CFG
+from utils import is_kanji
 from writer.ankiwriter import AnkiWriter
 
 
 class KanjiReader:
+    KANJI_FIELD = "Kanji"
+    MEANING_FIELD = "Kanji_Meaning"
 
-    def __init__(self):
+    def __init__(self, snapshot_path: Optional[str] = None):
+        """
+
+        :param snapshot_path: A json file to keep the kanji meanings in between sessions. The snapshot is rebuilt
+            whenever the notes of the kanji deck change.
+        """
         self.info_source = AnkiWriter(MAIN_CFG.collection,
                                       r"Maintain::Kanji and Radicals Sorted")  # TODO add to config
+        self.snapshot_path = snapshot_path
+        self.meanings: Dict[str, str] = self._load_meanings()
+
+    def _load_meanings(self) -> Dict[str, str]:
+        signature = self.info_source.notes_signature()
+        if self.snapshot_path is not None and os.path.isfile(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "r", encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                if snapshot["signature"] == signature:
+                    return snapshot["meanings"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        meanings = self._build_meanings()
+        if self.snapshot_path is not None:
+            # Replaced at once, so a reader that is killed mid write doesn't leave a truncated snapshot
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                json.dump({"signature": signature, "meanings": meanings}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
+        return meanings
+
+    def _build_meanings(self) -> Dict[str, str]:
+        notes_per_kanji: Dict[str, int] = dict()
+        meanings: Dict[str, str] = dict()
+        for _, values in self.info_source.iter_field_values([self.KANJI_FIELD, self.MEANING_FIELD]):
+            # Notes of other models in the deck may lack either field
+            if self.KANJI_FIELD not in values or self.MEANING_FIELD not in values:
+                continue
+            kanji = values[self.KANJI_FIELD]
+            notes_per_kanji[kanji] = notes_per_kanji.get(kanji, 0) + 1
+            meanings[kanji] = values[self.MEANING_FIELD]
+        # A kanji with more than one note is ambiguous, so it has no meaning
+        return {kanji: meaning for kanji, meaning in meanings.items() if notes_per_kanji[kanji] == 1}
 
     def get_meaning_of_kanji(self, kanji: str):
-        kanji_card = self.info_source.get_notes_by_value("Kanji", kanji)
-        if len(kanji_card) != 1:
-            return None
-        return kanji_card[0]['Kanji_Meaning']
+        return self.meanings.get(kanji)
 
     def extract_kanjis(self, word: str):
-        rt = []
-        for c in word:
-            if re.match('[\u3400-\u4DB5\u4E00-\u9FCB\uF900-\uFA6A]$', c):
-                rt.append(c)
-        return rt
+        return [c for c in word if is_kanji(c)]
 
     def extract_kanji_meaning_pairs(self, word: str):
         kanjis = self.extract_kanjis(word)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple, Any
+
+from utils import json_value
+
+
+class AnalysisCache:
+    """
+    Caches the output of text analysis tools (e.g. ichiran) by the flags and the normalized text they ran on.
+    Outputs are kept in memory in a least recently used order, evicting the oldest ones once the outputs take more
+    than `max_chars` characters. When `cache_dir` is given, every output is also stored on disk, so it survives
+    between sessions.
+    """
+    DISK_EXTENSION = ".json"
+
+    def __init__(self, max_chars: int = 32 * 1024 * 1024, cache_dir: Optional[str] = None):
+        if max_chars <= 0:
+            raise ValueError(f"cache size must be positive, got {max_chars}")
+        if cache_dir is not None:
+            if os.path.exists(cache_dir) and not os.path.isdir(cache_dir):
+                raise ValueError(f"{cache_dir} exists but isn't a directory")
+            os.makedirs(cache_dir, exist_ok=True)
+        self.max_chars = max_chars
+        self.cache_dir = cache_dir
+        self._entries: "OrderedDict[str, Tuple[str, Any]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.splitlines()).strip()
+
+    def key(self, flags: str, text: str) -> str:
+        return hashlib.sha256(f"{flags}\0{self.normalize(text)}".encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.DISK_EXTENSION)
+
+    def _remember(self, key: str, output: str, parsed: Any):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key)[0])
+            self._entries[key] = (output, parsed)
+            self._size += len(output)
+            while self._size > self.max_chars and len(self._entries) > 1:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _lookup(self, key: str) -> Optional[Tuple[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if self.cache_dir is None or not os.path.isfile(self._disk_path(key)):
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding='utf-8') as f:
+                output = json.load(f)["output"]
+        except (OSError, ValueError, KeyError):
+            return None
+        self._remember(key, output, None)
+        return output, None
+
+    def get(self, flags: str, text: str) -> Optional[str]:
+        entry = self._lookup(self.key(flags, text))
+        return None if entry is None else entry[0]
+
+    def put(self, flags: str, text: str, output: str, parsed: Any = None):
+        key = self.key(flags, text)
+        self._remember(key, output, parsed)
+        if self.cache_dir is not None:
+            # A unique temporary file, the same text may be stored by multiple threads at once
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding='utf-8') as f:
+                    json.dump({"flags": flags, "text": self.normalize(text), "output": output}, f, ensure_ascii=False)
+                os.replace(tmp_path, self._disk_path(key))
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+    def get_or_run(self, flags: str, text: str, run: Callable[[], str]) -> str:
+        """
+        :return: The cached output for the flags and text, running `run` and caching its result on a miss. Empty
+            outputs (a failed run) are not cached.
+        """
+        output = self.get(flags, text)
+        if output is None:
+            output = run()
+            if len(output.strip()) != 0:
+                self.put(flags, text, output)
+        return output
+
+    def get_json(self, flags: str, text: str, run: Callable[[], str]) -> json_value:
+        """
+        Like `get_or_run` for tools that output json. The output is parsed once and the parsed value is cached with
+        it, so it must not be modified by the caller. Outputs that fail to parse are not cached.
+        """
+        key = self.key(flags, text)
+        entry = self._lookup(key)
+        if entry is not None and entry[1] is not None:
+            return entry[1]
+        output = run() if entry is None else entry[0]
+        parsed = json.loads(output)
+        if entry is None:
+            self.put(flags, text, output, parsed)
+        else:
+            self._remember(key, output, parsed)
+        return parsed
@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, Any
+
+from reader.ichiran_reader import IchiranReader
+from reader.subtitle_reader import SubtitleEvent
+from reader.video_reader import VideoReader
+
+
+class AssetPrefetcher:
+    """
+    Prepares the assets of cards that are likely to be mined before they are asked for - the screenshot, the audio
+    and the furigana of every candidate line. Assets are kept by the key of the `VideoReader.extract_batch` request
+    that made them (or ("furigana", text)), in a least recently used order. Once there are more than `max_entries`
+    of them the oldest are dropped, and their files are deleted.
+    """
+    FURIGANA = "furigana"
+
+    def __init__(self, vid_reader: VideoReader, ichi_reader: IchiranReader, executor: Executor,
+                 max_entries: int = 32):
+        if max_entries <= 0:
+            raise ValueError(f"max_entries must be positive, got {max_entries}")
+        self.vid_reader = vid_reader
+        self.ichi_reader = ichi_reader
+        self.executor = executor
+        self.max_entries = max_entries
+        # key -> (future, key of the result in the future's result or None if the future's result is the asset)
+        self._entries: "OrderedDict[Hashable, Tuple[Future, Optional[Hashable]]]" = OrderedDict()
+        # future -> the amount of entries made by it, a future no entry is left for is cancelled
+        self._references: Dict[Future, int] = dict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, events: List[SubtitleEvent], timestamp: float):
+        """
+        Starts preparing the screenshot at the timestamp, and the audio and furigana of every event.
+        """
+        requests = [(VideoReader.IMAGE, timestamp, timestamp)]
+        requests += [(VideoReader.AUDIO, event.t0, event.t1) for event in events]
+        with self._lock:
+            requests = [request for request in dict.fromkeys(requests) if request not in self._entries]
+            texts = [text for text in dict.fromkeys(event.text for event in events)
+                     if (self.FURIGANA, text) not in self._entries]
+        if len(requests) != 0:
+            # A single batch, so all the media comes from one pass over the video
+            media = self.executor.submit(self.vid_reader.extract_batch, requests)
+            for request in requests:
+                self._add(request, media, request)
+        for text in texts:
+            self._add((self.FURIGANA, text), self.executor.submit(self.ichi_reader.to_furigana, text), None)
+
+    def _add(self, key: Hashable, future: Future, result_key: Optional[Hashable]):
+        evicted = []
+        with self._lock:
+            self._entries[key] = (future, result_key)
+            self._references[future] = self._references.get(future, 0) + 1
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for entry in evicted:
+            self._discard(entry)
+
+    def _release(self, future: Future):
+        """
+        Called whenever an entry of the future is dropped or taken. Once no entry is left for the future, it is
+        cancelled if it didn't start yet, so stale work doesn't hold up the executor.
+        """
+        with self._lock:
+            self._references[future] -= 1
+            if self._references[future] != 0:
+                return
+            del self._references[future]
+        future.cancel()
+
+    def _discard(self, entry: Tuple[Future, Optional[Hashable]]):
+        future, result_key = entry
+        self._release(future)
+        if result_key is None:
+            return
+
+        def discard_file(done: Future):
+            if not done.cancelled() and done.exception() is None:
+                self.vid_reader.discard(done.result()[result_key])
+        # Files of running extractions are deleted once they are written
+        future.add_done_callback(discard_file)
+
+    def get(self, key: Hashable, fallback: Callable[[], Any]) -> Any:
+        """
+        Takes a prefetched asset, waiting for it if it is already being prepared. The asset is removed from the
+        prefetcher, so its file is the caller's from now on.
+        :param fallback: Makes the asset when it wasn't prefetched, preparing it didn't start yet, or it failed.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return fallback()
+        future, result_key = entry
+        if not future.running() and not future.done():
+            # Still queued behind other prefetches, waiting for it could take longer than making it now
+            self._discard(entry)
+            return fallback()
+        self._release(future)
+        try:
+            result = future.result()
+        except Exception:
+            return fallback()
+        return result if result_key is None else result[result_key]
+
+    def clear(self):
+        """
+        Drops all the prefetched assets and deletes their files.
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            self._discard(entry)
@@ -0,0 +1,234 @@
+import bisect
+import json
+import os
+import subprocess
+import threading
+from array import array
+from typing import Optional, Iterable, Iterator, Tuple, Dict, List
+
+import numpy as np
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+
+from utils import compute_quick_file_hash
+
+
+class KeyframeIndex:
+    """
+    The times (in seconds) of the keyframes of the first video stream of a file. Decoding any frame has to start
+    from the keyframe before it, so the index tells whether seeking or reading forward gets to a frame faster.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, times: array):
+        self.times = times
+
+    @staticmethod
+    def build(video_loc: str) -> "KeyframeIndex":
+        """
+        Reads the packets of the video stream without decoding them, which takes about as long as reading the file.
+        """
+        cmd = [get_setting("FFMPEG_BINARY"), "-loglevel", "error", "-i", video_loc,
+               "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                                encoding='utf-8')
+        if result.returncode != 0:
+            raise RuntimeError(f"couldn't index keyframes of {video_loc}: {result.stderr}")
+
+        time_base = None
+        times = array("d")
+        for line in result.stdout.splitlines():
+            if line.startswith("#tb 0:"):
+                num, den = line.split(":")[1].strip().split("/")
+                time_base = int(num) / int(den)
+            elif not line.startswith("#") and len(line.strip()) != 0:
+                # stream, dts, pts, duration, size, crc and flags, which are only written for non key packets
+                columns = line.split(",")
+                if len(columns) == 6 and time_base is not None:
+                    times.append(int(columns[2]) * time_base)
+        if time_base is None:
+            raise RuntimeError(f"couldn't index keyframes of {video_loc}: no time base in ffmpeg output")
+        return KeyframeIndex(array("d", sorted(times)))
+
+    @staticmethod
+    def from_video(video_loc: str, cache_dir: Optional[str] = None) -> "KeyframeIndex":
+        """
+        :param cache_dir: When given, indexes are kept there by a hash of the video, so every video is only indexed
+            once.
+        """
+        if cache_dir is None:
+            return KeyframeIndex.build(video_loc)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, compute_quick_file_hash(video_loc) + ".json")
+        try:
+            with open(cache_path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+            if data["version"] == KeyframeIndex.CACHE_VERSION:
+                return KeyframeIndex(array("d", data["keyframes"]))
+        except (OSError, ValueError, KeyError):
+            pass
+
+        index = KeyframeIndex.build(video_loc)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump({"version": KeyframeIndex.CACHE_VERSION, "keyframes": index.times.tolist()}, f)
+        os.replace(tmp_path, cache_path)
+        return index
+
+    def keyframe_before(self, t: float) -> float:
+        """
+        :return: The time of the last keyframe at or before t, which decoding the frame at t has to start from.
+        """
+        i = bisect.bisect_right(self.times, t)
+        return self.times[i - 1] if i != 0 else 0.0
+
+    def has_keyframe_between(self, t0: float, t1: float) -> bool:
+        """
+        :return: Whether there is a keyframe in (t0, t1].
+        """
+        return bisect.bisect_right(self.times, t0) != bisect.bisect_right(self.times, t1)
+
+
+class _SeekingVideoReader(FFMPEG_VideoReader):
+    """
+    moviepy's reader, except that it seeks only on the input. ffmpeg then decodes from the keyframe before the
+    requested time and drops the earlier frames before scaling and converting them, instead of also converting the
+    last second of frames before the requested time.
+    """
+
+    def initialize(self, starttime=0):
+        self.close()
+
+        i_arg = ['-i', self.filename] if starttime == 0 else ['-ss', "%.06f" % starttime, '-i', self.filename]
+        cmd = ([get_setting("FFMPEG_BINARY")] + i_arg +
+               ['-loglevel', 'error',
+                # Without this ffmpeg repeats the first frame to fill the time between the seek and the frame
+                '-vsync', '0',
+                '-f', 'image2pipe',
+                '-vf', 'scale=%d:%d' % tuple(self.size),
+                '-sws_flags', self.resize_algo,
+                "-pix_fmt", self.pix_fmt,
+                '-vcodec', 'rawvideo', '-'])
+        popen_params = {"bufsize": self.bufsize,
+                        "stdout": subprocess.PIPE,
+                        "stderr": subprocess.PIPE,
+                        "stdin": subprocess.DEVNULL}
+        if os.name == "nt":
+            popen_params["creationflags"] = 0x08000000
+
+        self.proc = subprocess.Popen(cmd, **popen_params)
+
+
+class FrameGrabber:
+    """
+    Gets frames of a video as arrays, keeping a single ffmpeg decoder open between requests. A request reads forward
+    from the current position of the decoder when no keyframe is on the way (seeking would decode the same frames
+    again), and seeks otherwise.
+    """
+    # Starting ffmpeg and seeking costs about as much as decoding this many seconds of video
+    SEEK_COST = 2.0
+    # The amount of frames selected by a single ffmpeg run in `iter_frames`
+    MAX_SELECTED_FRAMES = 64
+
+    def __init__(self, video_loc: str, cache_dir: Optional[str] = None):
+        """
+
+        :param video_loc: The video file.
+        :param cache_dir: A directory to keep the keyframe indexes of videos in. When None is passed, the video is
+            indexed every time it is opened.
+        """
+        self.keyframes = KeyframeIndex.from_video(video_loc, cache_dir)
+        self.reader = _SeekingVideoReader(video_loc)
+        self.fps = self.reader.fps
+        self.size = self.reader.size
+        self._lock = threading.Lock()
+
+    def _frame_time(self, pos: int) -> float:
+        return (pos - 1) / self.fps
+
+    def _frame_pos(self, t: float) -> int:
+        # moviepy's numbering, where frame n (counting from 1) is shown from (n - 1) / fps
+        return min(int(self.fps * t + 0.00001) + 1, max(self.reader.nframes, 1))
+
+    def get_frame(self, t: float) -> np.ndarray:
+        """
+        :return: The frame shown at time t, as an array of RGB values with the shape (height, width, 3). The array
+            may be shared with later calls, so it must not be modified.
+        """
+        with self._lock:
+            pos = self._frame_pos(t)
+            if self.reader.proc is not None and pos == self.reader.pos:
+                return self.reader.lastread
+
+            if (self.reader.proc is None or pos < self.reader.pos
+                    or self.keyframes.has_keyframe_between(self._frame_time(self.reader.pos),
+                                                           self._frame_time(pos))):
+                # Half a frame early, so rounded timestamps of the requested frame don't make ffmpeg skip it
+                self.reader.initialize(max(0.0, (pos - 1.5) / self.fps))
+                self.reader.pos = pos - 1
+            self.reader.skip_frames(pos - self.reader.pos - 1)
+            frame = self.reader.read_frame()
+            self.reader.pos = pos
+            return frame
+
+    def iter_frames(self, times: Iterable[float]) -> Iterator[Tuple[float, np.ndarray]]:
+        """
+        Gets many frames in as few forward passes over the video as possible. Every ffmpeg run decodes the video
+        from the keyframe before its first frame, and only the requested frames are converted and sent back. A new
+        run (a seek) is started only when decoding up to the next frame would cost more than seeking to it.
+        Doesn't use or move the decoder of `get_frame`.
+        :return: Pairs of a requested time and the frame shown at that time, in the order of the frames.
+        """
+        times_by_pos: Dict[int, List[float]] = dict()
+        for t in times:
+            times_by_pos.setdefault(self._frame_pos(t), []).append(t)
+
+        run: List[int] = []
+        for pos in sorted(times_by_pos.keys()):
+            if len(run) != 0 and (len(run) == self.MAX_SELECTED_FRAMES or self._should_seek(run[-1], pos)):
+                yield from self._read_run(run, times_by_pos)
+                run = []
+            run.append(pos)
+        if len(run) != 0:
+            yield from self._read_run(run, times_by_pos)
+
+    def _should_seek(self, from_pos: int, to_pos: int) -> bool:
+        t0, t1 = self._frame_time(from_pos), self._frame_time(to_pos)
+        keyframe = self.keyframes.keyframe_before(t1)
+        return keyframe > t0 and t1 - t0 > t1 - keyframe + self.SEEK_COST
+
+    def _read_run(self, run: List[int], times_by_pos: Dict[int, List[float]]) -> Iterator[Tuple[float, np.ndarray]]:
+        start = max(0.0, (run[0] - 1.5) / self.fps)
+        # The seek makes the first frame of the run the first decoded frame, and like moviepy the frame rate is
+        # taken to be constant, so frames are selected by how far they are from it
+        select = "+".join(f"eq(n,{pos - run[0]})" for pos in run)
+        i_arg = ['-i', self.reader.filename] if start == 0 else ['-ss', "%.06f" % start, '-i', self.reader.filename]
+        cmd = ([get_setting("FFMPEG_BINARY")] + i_arg +
+               ['-loglevel', 'error',
+                '-vsync', '0',
+                '-vf', f"select='{select}',scale=%d:%d" % tuple(self.size),
+                '-sws_flags', self.reader.resize_algo,
+                '-pix_fmt', self.reader.pix_fmt,
+                '-f', 'image2pipe',
+                '-vcodec', 'rawvideo', '-'])
+        w, h = self.size
+        nbytes = self.reader.depth * w * h
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                                bufsize=nbytes + 100)
+        try:
+            for pos in run:
+                data = proc.stdout.read(nbytes)
+                if len(data) != nbytes:
+                    raise RuntimeError(f"ffmpeg returned no frame at {self._frame_time(pos)} of {self.reader.filename}")
+                frame = np.frombuffer(data, dtype='uint8').reshape((h, w, self.reader.depth))
+                for t in times_by_pos[pos]:
+                    yield t, frame
+        finally:
+            proc.kill()
+            proc.stdout.close()
+            proc.wait()
+
+    def close(self):
+        with self._lock:
+            self.reader.close()
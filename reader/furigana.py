@@ -0,0 +1,69 @@
+from typing import Iterable, List, Optional, Tuple
+
+
+class RubySegment:
+
+    def __init__(self, text: str, reading: Optional[str] = None):
+        """
+
+        :param text: A part of the original text.
+        :param reading: The kana reading shown above the text, or None for text shown as is.
+        """
+        self.text = text
+        self.reading = reading
+
+    def to_anki(self) -> str:
+        if self.reading is None:
+            return self.text
+        return f" {self.text}[{self.reading}]"
+
+    def to_js(self):
+        return {
+            'text': self.text,
+            'reading': self.reading
+        }
+
+    def __repr__(self):
+        return self.to_anki()
+
+
+def align_furigana(text: str, spans: Iterable[Tuple[str, Optional[str]]], strict: bool = True) -> List[RubySegment]:
+    """
+    Aligns segmented (surface, reading) spans to the text they were segmented from in a single pass. Parts of the
+    text that aren't covered by any span (e.g. punctuation a segmenter skipped) are kept as plain segments.
+    :param text: The original text.
+    :param spans: The segments in the order they appear in the text. The reading is None for text without furigana.
+    :param strict: When True, a span that can't be found in the rest of the text is an error. Otherwise it is kept
+        as is, and stands for the text up to where the next span is found (e.g. when the segmenter normalized
+        half-width characters), so that text isn't kept as well.
+    :return: The ruby segments that make up the text.
+    """
+    rt = []
+    pos = 0
+    unmatched = False
+    for surface, reading in spans:
+        if len(surface) == 0:
+            continue
+        found = text.find(surface, pos)
+        if found == -1:
+            if strict:
+                raise RuntimeError(f"Can't find {surface} in {text}")
+            rt.append(RubySegment(surface, reading))
+            unmatched = True
+            continue
+        if found != pos and not unmatched:
+            rt.append(RubySegment(text[pos:found]))
+        rt.append(RubySegment(surface, reading))
+        pos = found + len(surface)
+        unmatched = False
+
+    if pos != len(text) and not unmatched:
+        rt.append(RubySegment(text[pos:]))
+    return rt
+
+
+def to_anki_furigana(segments: Iterable[RubySegment]) -> str:
+    """
+    :return: The segments in Anki's furigana format - ` kanji[kana]` for every segment with a reading.
+    """
+    return "".join([segment.to_anki() for segment in segments])
@@ -1,8 +1,18 @@
+import asyncio
+import atexit
+import json
+import os
 import re
-from time import sleep, time
+import tempfile
+import threading
+from time import time
+from typing import Dict, List, Optional, Tuple, AsyncIterator, Iterable
 
 import requests
 
+from reader.furigana import RubySegment, align_furigana, to_anki_furigana
+from utils import TokenBucket
+
 
 class IchiReader:
     ICHI_BASE = "https://ichi.moe/cl/qr/?q=+{}"
@@ -11,55 +21,148 @@ class IchiReader:
         r"<dl class=\"alternatives\">\s*"
         r"<dt>\s*([^【】\s<>\\\/]+?)\s*(【(.+?)】)?\s*<\/dt>")
 
-    def __init__(self, network_wait: float = 5.0):
-        self.last_network_call = 0
+    def __init__(self, network_wait: float = 5.0,
+                 base_url: str = ICHI_BASE,
+                 cache_path: Optional[str] = None,
+                 cache_ttl: float = 30 * 24 * 60 * 60,
+                 burst: int = 1,
+                 cache_save_interval: float = 30.0):
+        """
+
+        :param network_wait: The average amount of seconds between requests to the server. 0 (or less) for no limit.
+        :param base_url: The url to query, with `{}` in place of the text.
+        :param cache_path: A json file to keep the server's answers in between sessions. When None is passed, the
+            answers are only cached in memory.
+        :param cache_ttl: How long (in seconds) a cached answer is used before asking the server again.
+        :param burst: How many requests can be sent without waiting after being idle.
+        :param cache_save_interval: New answers are written to the cache file at most once in this many seconds, and
+            when the program exits.
+        """
+        self.base_url = base_url
         self.network_wait = network_wait
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.cache_save_interval = cache_save_interval
+        self.session = requests.Session()
+        self.limiter = TokenBucket(rate=1.0 / network_wait, capacity=burst) if network_wait > 0 else None
+        self._cache_lock = threading.Lock()
+        # Only one thread writes the cache file at a time, without blocking the threads using the cache
+        self._save_lock = threading.Lock()
+        # text -> (time fetched, answer html)
+        self._cache: Dict[str, Tuple[float, str]] = self._load_cache()
+        self._cache_dirty = False
+        self._last_save = time()
+        if self.cache_path is not None:
+            atexit.register(self.save_cache)
+
+    def _load_cache(self) -> Dict[str, Tuple[float, str]]:
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return dict()
+        try:
+            with open(self.cache_path, "r", encoding='utf-8') as f:
+                return {text: (fetched, html) for text, (fetched, html) in json.load(f).items()}
+        except (OSError, ValueError, TypeError):
+            return dict()
+
+    def save_cache(self):
+        """
+        Writes the cache file if answers were added since it was last written. Expired answers are dropped.
+        """
+        if self.cache_path is None:
+            return
+        with self._save_lock:
+            with self._cache_lock:
+                if not self._cache_dirty:
+                    return
+                now = time()
+                self._cache = {text: entry for text, entry in self._cache.items()
+                               if now - entry[0] <= self.cache_ttl}
+                snapshot = dict(self._cache)
+                self._cache_dirty = False
+                self._last_save = now
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_path)), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding='utf-8') as f:
+                    json.dump(snapshot, f, ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+    def _cached_answer(self, text: str) -> Optional[str]:
+        with self._cache_lock:
+            entry = self._cache.get(text)
+        if entry is None or time() - entry[0] > self.cache_ttl:
+            return None
+        return entry[1]
+
+    def _download(self, text: str) -> str:
+        answer = self.session.get(self.base_url.format(text))
+        answer.raise_for_status()
+        with self._cache_lock:
+            self._cache[text] = (time(), answer.text)
+            self._cache_dirty = True
+            # Writing the whole file for every answer would make a batch of texts quadratic
+            save_due = time() - self._last_save >= self.cache_save_interval
+        if save_due:
+            self.save_cache()
+        return answer.text
+
+    def fetch(self, text: str) -> str:
+        """
+        :return: The html the server answers for the text, from the cache if possible.
+        """
+        cached = self._cached_answer(text)
+        if cached is not None:
+            return cached
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return self._download(text)
+
+    async def fetch_async(self, text: str) -> str:
+        cached = self._cached_answer(text)
+        if cached is not None:
+            return cached
+        if self.limiter is not None:
+            await self.limiter.acquire_async()
+        return await asyncio.to_thread(self._download, text)
 
     def to_furigana(self, text: str):
-        t_passed = time() - self.last_network_call
-        if t_passed < self.network_wait:
-            sleep(self.network_wait - t_passed)
-        answer = requests.get(self.ICHI_BASE.format(text))
-        self.last_network_call = time()
-        results = self.JP_TEXT_RE.findall(answer.text)
+        return self.html_to_furigana(text, self.fetch(text))
+
+    async def iter_furigana(self, texts: Iterable[str]) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Queues all the texts at once and yields (text, furigana) pairs as the answers arrive. Cached texts come
+        first, the rest as fast as the rate limit allows.
+        """
+
+        async def furigana_of(txt: str) -> Tuple[str, str]:
+            return txt, self.html_to_furigana(txt, await self.fetch_async(txt))
+
+        for task in asyncio.as_completed([furigana_of(text) for text in texts]):
+            yield await task
+
+    async def to_furigana_batch(self, texts: List[str]) -> List[str]:
+        """
+        :return: The furigana of every text, in the order of the given texts.
+        """
+        results = dict()
+        async for text, furigana in self.iter_furigana(dict.fromkeys(texts)):
+            results[text] = furigana
+        return [results[text] for text in texts]
+
+    def to_furigana_segments(self, text: str) -> List[RubySegment]:
+        return self.html_to_segments(text, self.fetch(text))
+
+    def html_to_segments(self, text: str, html: str) -> List[RubySegment]:
+        results = self.JP_TEXT_RE.findall(html)
         # index 0 = matched word
         # index 1 = furigana (with brackets)
         # index 2 = furigana (no brackets)
+        return align_furigana(text, [(result[0], result[2] if len(result[1]) != 0 else None) for result in results])
 
-        rt = ""
-        curr_ind = 0
-        len_increase = 0
-        for result in results:
-            curr = result[0]
-
-            chars_moved = 0
-            matches = 0
-            for i in range(curr_ind, len(text)):
-                if matches == len(curr):
-                    break
-                if text[i] != curr[matches]:
-                    for j in range(i - matches, i + 1):
-                        rt += text[j]
-                    matches = 0
-                else:
-                    matches += 1
-                chars_moved += 1
-            if matches != len(curr):
-                raise RuntimeError(f"Can't find {curr} in {text}")
-            curr_ind += chars_moved
-
-            if len(result[1]) == 0:
-                rt += curr
-            else:
-                rt += f" {curr}[{result[2]}]"
-                len_increase += 3 + len(result[2])
-
-        rt += text[curr_ind:]
-
-        if len(rt) != len(text) + len_increase:
-            raise RuntimeError(f"Length of output {rt} doesn't match input {text}")
-
-        return rt
+    def html_to_furigana(self, text: str, html: str) -> str:
+        return to_anki_furigana(self.html_to_segments(text, html))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,151 @@
+import json
+import queue
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class IchiranWorkerError(RuntimeError):
+    """
+    The worker process timed out, crashed or answered with something that isn't part of the protocol.
+    """
+    pass
+
+
+class IchiranWorker:
+    """
+    A long-lived ichiran process (sbcl with ichiran loaded running the read loop in `reader/ichiran_worker.lisp`),
+    so the Lisp startup cost is paid once instead of on every call.
+
+    The process speaks a line protocol over stdin/stdout: every request is one json line
+    `{"flags": "-f", "text": "..."}` and every answer is one json line, either `{"output": "..."}` holding what
+    `ichiran-cli` would have printed for these flags, or `{"error": "..."}`.
+    """
+
+    def __init__(self, cmd: List[str]):
+        self.cmd = cmd
+        self.process: Optional[subprocess.Popen] = None
+        self._answers: queue.Queue = queue.Queue()
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        encoding='utf-8', bufsize=1)
+        # Every process gets its own queue, so a late answer of a killed process can't be taken as a new answer
+        self._answers = queue.Queue()
+        threading.Thread(target=self._read_answers, args=(self.process, self._answers), daemon=True).start()
+
+    @staticmethod
+    def _read_answers(process: subprocess.Popen, answers: queue.Queue):
+        for line in process.stdout:
+            answers.put(line)
+        answers.put(None)
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def kill(self):
+        """
+        Kills the process without waiting for it, from any thread. A request waiting on it fails, and the worker is
+        restarted before it is used again.
+        """
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def request(self, flags: str, text: str, timeout: float) -> str:
+        try:
+            self.process.stdin.write(json.dumps({"flags": flags, "text": text}, ensure_ascii=False) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise IchiranWorkerError(f"couldn't send request to ichiran worker: {e}")
+
+        try:
+            answer = self._answers.get(timeout=timeout)
+        except queue.Empty:
+            raise IchiranWorkerError(f"ichiran worker didn't answer within {timeout} seconds")
+        if answer is None:
+            raise IchiranWorkerError("ichiran worker exited")
+
+        try:
+            answer = json.loads(answer)
+        except ValueError:
+            raise IchiranWorkerError(f"ichiran worker answered with invalid json {answer}")
+        if not isinstance(answer, dict):
+            raise IchiranWorkerError(f"ichiran worker answered with invalid json {answer}")
+        if "error" in answer:
+            raise RuntimeError(f"ichiran failed on \"{text}\": {answer['error']}")
+        if "output" not in answer:
+            raise IchiranWorkerError(f"ichiran worker answer {answer} has no output")
+        return answer["output"]
+
+
+class IchiranPool:
+    """
+    A fixed amount of `IchiranWorker`s. Requests wait for a free worker, and a worker that times out or crashes is
+    restarted before it is used again. A worker that stays busy for longer than a request may take is stuck, and is
+    killed once a request can't get a worker.
+    """
+
+    def __init__(self, cmd: List[str], size: int = 2, timeout: float = 30.0):
+        if size <= 0:
+            raise ValueError(f"pool size must be positive, got {size}")
+        self.timeout = timeout
+        self._workers = [IchiranWorker(cmd) for _ in range(size)]
+        self._idle: queue.Queue = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        # worker -> when it was taken, for the workers running a request
+        self._busy: Dict[IchiranWorker, float] = dict()
+        self._busy_lock = threading.Lock()
+
+    def _take_worker(self) -> IchiranWorker:
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            pass
+        # Requests time out, so a worker busy for longer than that is stuck (e.g. writing to a process that stopped
+        # reading). Killing its process fails its request, which gives the worker back to be restarted
+        now = time.monotonic()
+        with self._busy_lock:
+            stuck = [worker for worker, taken in self._busy.items() if now - taken > self.timeout]
+        for worker in stuck:
+            worker.kill()
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise IchiranWorkerError(f"no ichiran worker became free within {2 * self.timeout} seconds")
+
+    def run(self, flags: str, text: str) -> str:
+        worker = self._take_worker()
+        with self._busy_lock:
+            self._busy[worker] = time.monotonic()
+        try:
+            if not worker.is_alive():
+                worker.restart()
+            try:
+                return worker.request(flags, text, self.timeout)
+            except IchiranWorkerError:
+                worker.restart()
+                raise
+        finally:
+            with self._busy_lock:
+                self._busy.pop(worker)
+            self._idle.put(worker)
+
+    def close(self):
+        for worker in self._workers:
+            worker.stop()
@@ -1,14 +1,29 @@
-import json
 import subprocess
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import config
+from reader.analysis_cache import AnalysisCache
+from reader.furigana import RubySegment, align_furigana, to_anki_furigana
+from reader.ichiran_pool import IchiranPool
+from utils import json_value
 
 
 class IchiranReader:
 
-    def __init__(self):
+    def __init__(self, pool: Optional[IchiranPool] = None, cache: Optional[AnalysisCache] = None):
+        """
+
+        :param pool: Persistent ichiran workers to send the commands to. When None is passed, a pool is started if
+            `ichiran_worker` is configured, and otherwise every command runs a new `ichiran-cli` process.
+        :param cache: Where the ichiran outputs are cached. When None is passed, an in memory cache is used.
+        """
         self.cli_tool = config.MAIN_CFG["ichiran_cli"]
+        if pool is None and config.MAIN_CFG.get("ichiran_worker") is not None:
+            pool = IchiranPool(config.MAIN_CFG["ichiran_worker"],
+                               size=config.MAIN_CFG.get("ichiran_workers", 2),
+                               timeout=config.MAIN_CFG.get("ichiran_timeout", 30.0))
+        self.pool = pool
+        self.cache = cache if cache is not None else AnalysisCache()
 
     def modify_for_cli(self, text: str) -> str:
         # to_escape = '"\\'
@@ -22,12 +37,30 @@ class IchiranReader:
     def run_ichiran_cmd(self, flags: str, text: str) -> str:
         if not all([(len(flg) == 2 and flg[0] == '-') or len(flg) == 1 for flg in flags.split()]):
             raise RuntimeError(f"flags: \"{flags}\" not legal format (-a -b -c ...)")
+        if self.pool is not None:
+            return self.pool.run(flags, self.modify_for_cli(text))
         result = subprocess.Popen([self.cli_tool, flags, f"{self.modify_for_cli(text)}"],
                                   shell=True, stdout=subprocess.PIPE)
         return result.stdout.read().decode('utf-8')
 
+    def query(self, flags: str, text: str) -> str:
+        """
+        Like `run_ichiran_cmd`, but ichiran only runs if the output for these flags and text isn't cached yet.
+        """
+        return self.cache.get_or_run(flags, text, lambda: self.run_ichiran_cmd(flags=flags, text=text))
+
+    def analyze(self, text: str) -> json_value:
+        """
+        :return: The full (`-f`) ichiran analysis of the text, parsed from json. The value is shared through the
+            cache, so it must not be modified.
+        """
+        return self.cache.get_json('-f', text, lambda: self.run_ichiran_cmd(flags='-f', text=text))
+
     def to_furigana(self, text: str) -> str:
-        result = json.loads(self.run_ichiran_cmd(flags='-f', text=text))
+        return to_anki_furigana(self.to_furigana_segments(text))
+
+    def to_furigana_segments(self, text: str) -> List[RubySegment]:
+        result = self.analyze(text)
         # output is list of sentence sections, each a str or a set of fragmentations
         # each fragmentation is a list of fragments, and the score
         # each fragment is a list, of the romanization, the details dict and some unknown third list
@@ -38,10 +71,10 @@ class IchiranReader:
         #   (each meaning has a position at 'pos' and meaning at 'gloss')
         #   * IF MANY COMPONENTS: 'components' -> list of components (same structure as the details dict)
         #   * IF CONJUGATED: 'conj' -> details about the conjugation with definition at 'gloss'
-        res = ""
+        spans = []
         for section in result:
             if isinstance(section, str):
-                res += section
+                spans.append((section, None))
             else:
                 fragments = section[0][0]  # get first (only) fragmentation, from it the fragments (not score)
                 for romanization, details, _ in fragments:
@@ -50,17 +83,63 @@ class IchiranReader:
                     reading = details['reading']
                     orig = details['text']
                     kana = details['kana']
-                    if orig == reading:
-                        res += orig
-                    else:
-                        res += f' {orig}[{kana}]'
-        return res
+                    spans.append((orig, None if orig == reading else kana))
+        # ichiran may leave out parts of the text (e.g. whitespace), so text it didn't return is kept as is
+        return align_furigana(self.modify_for_cli(text), spans, strict=False)
 
     def to_deconstruction(self, text: str) -> str:
-        return self.run_ichiran_cmd(flags='-i', text=text)
+        """
+        :return: The deconstruction of the text in the layout of the `-i` output, rendered from the cached `-f`
+            analysis so no extra ichiran run is needed.
+        """
+        return self.analysis_to_deconstruction(self.analyze(text))
+
+    @staticmethod
+    def analysis_to_deconstruction(analysis: json_value) -> str:
+        """
+        Renders a full (`-f`) analysis in the human readable layout of the `-i` output, so both can be shown from a
+        single ichiran run.
+        """
+        romanized = []
+        lines = []
+        for section in analysis:
+            if isinstance(section, str):
+                romanized.append(section.strip())
+                continue
+            fragments = section[0][0]
+            for romanization, details, _ in fragments:
+                romanized.append(romanization)
+                IchiranReader._render_details(details, lines, "")
+        return "\n".join([" ".join(r for r in romanized if len(r) != 0)] + lines)
+
+    @staticmethod
+    def _render_details(details: json_value, lines: List[str], indent: str):
+        if 'alternative' in details:
+            for alternative in details['alternative']:
+                IchiranReader._render_details(alternative, lines, indent)
+            return
+        lines.append(f"{indent}* {details.get('reading', details.get('text', ''))}")
+        if 'components' in details:
+            for component in details['components']:
+                IchiranReader._render_details(component, lines, indent + "  ")
+            return
+        for i, meaning in enumerate(details.get('gloss', [])):
+            info = f" 《{meaning['info']}》" if 'info' in meaning else ""
+            lines.append(f"{indent}{i + 1}. {meaning.get('pos', '')} {meaning.get('gloss', '')}{info}")
+        for conj in details.get('conj', []):
+            for prop in conj.get('prop', []):
+                negative = " Negative" if prop.get('neg') else ""
+                lines.append(f"{indent}[ Conjugation: {prop.get('pos', '')} {prop.get('type', '')}{negative} ]")
+            if 'reading' in conj:
+                lines.append(f"{indent}  {conj['reading']}")
+            for i, meaning in enumerate(conj.get('gloss', [])):
+                lines.append(f"{indent}  {i + 1}. {meaning.get('pos', '')} {meaning.get('gloss', '')}")
+            if 'via' in conj:
+                for via in conj['via']:
+                    IchiranReader._render_details(via, lines, indent + "  ")
 
     def to_definitions(self, text: str) -> List[Dict[str, str]]:
-        result = json.loads(self.run_ichiran_cmd(flags='-f', text=text))
+        result = self.analyze(text)
         if len(result) != 1:
             raise RuntimeError(f"got more than one section! {result}")
         frags = result[0][0][0]
@@ -76,7 +155,7 @@ class IchiranReader:
         return details['gloss']
 
     def to_spelling(self, text: str) -> List[Dict[str, str]]:
-        result = json.loads(self.run_ichiran_cmd(flags='-f', text=text))
+        result = self.analyze(text)
         if len(result) != 1:
             raise RuntimeError(f"got more than one section! {result}")
         frags = result[0][0][0]
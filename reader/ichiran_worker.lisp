@@ -0,0 +1,55 @@
+;;;; A persistent ichiran worker, speaking the line protocol of IchiranWorker (reader/ichiran_pool.py).
+;;;;
+;;;; Every request read from stdin is one json line {"flags": "-f", "text": "..."}, and every answer written to
+;;;; stdout is one json line, {"output": "..."} holding what ichiran-cli prints for these flags, or {"error": "..."}.
+;;;; The outputs are made the same way as in ichiran's cli.lisp - keep them in line with it when updating ichiran.
+;;;;
+;;;; ichiran must be installed as a quicklisp local project with its database set up (see ichiran's README), so
+;;;; (ql:quickload :ichiran) works in sbcl. The worker is then started with
+;;;;     sbcl --noinform --non-interactive --load <path to this file>
+;;;; Loading ichiran takes a few seconds, requests sent in the meantime are answered once it is loaded.
+
+(let ((*standard-output* (make-broadcast-stream)))
+  ;; Nothing but answers may be written to stdout
+  (ql:quickload :ichiran :silent t))
+
+(defpackage :ankiminer/ichiran-worker
+  (:use :cl))
+
+(in-package :ankiminer/ichiran-worker)
+
+(defun print-romanize-info (info)
+  (loop for (word . gloss) in info
+        do (format t "~%~%* ~a  ~a" word gloss)))
+
+(defun run (flags text)
+  "What ichiran-cli prints for the flags and the text."
+  (let ((flags (remove "" (uiop:split-string flags) :test #'string=)))
+    (with-output-to-string (*standard-output*)
+      (cond ((null flags)
+             (princ (ichiran::romanize text)))
+            ((equal flags '("-f"))
+             (princ (jsown:to-json (ichiran::romanize* text :limit 1))))
+            ((equal flags '("-i"))
+             (multiple-value-bind (result info) (ichiran::romanize text :with-info t)
+               (princ result)
+               (print-romanize-info info)))
+            (t (error "unsupported flags ~{~a~^ ~}" flags))))))
+
+(defun answer (request-line)
+  (handler-case
+      (let ((request (jsown:parse request-line)))
+        (jsown:new-js ("output" (run (jsown:val request "flags") (jsown:val request "text")))))
+    (error (e)
+      (jsown:new-js ("error" (princ-to-string e))))))
+
+(defun main ()
+  (let ((in (sb-sys:make-fd-stream 0 :input t :external-format :utf-8 :buffering :full))
+        (out (sb-sys:make-fd-stream 1 :output t :external-format :utf-8 :buffering :full)))
+    (loop for line = (read-line in nil)
+          while line
+          unless (string= (string-trim '(#\Space #\Tab #\Return) line) "")
+            do (write-line (jsown:to-json (answer line)) out)
+               (finish-output out))))
+
+(main)
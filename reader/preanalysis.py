@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from reader.ichiran_reader import IchiranReader
+from reader.subtitle_reader import GenericReader
+
+
+class SubtitlePreanalyzer:
+    """
+    Runs ichiran in the background over every line of a subtitle file, so the analysis of a line is already cached
+    by the time it is mined. The full analysis of every line (which the furigana, the word list and the
+    deconstruction are all built from) is stored in the cache of the `IchiranReader`, which keeps it on disk when
+    it was given a cache directory.
+    Lines are handed to the workers in chunks of `chunk_size`, to keep the amount of queued tasks low. Every line
+    is still analyzed by its own ichiran run.
+    """
+
+    def __init__(self, ichi_reader: IchiranReader, sub_reader: GenericReader,
+                 max_workers: int = 2, chunk_size: int = 16):
+        if max_workers <= 0 or chunk_size <= 0:
+            raise ValueError("max_workers and chunk_size must be positive")
+        self.ichi_reader = ichi_reader
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+        # Lines repeat a lot in subtitles, every text only needs to be analyzed once
+        self.texts: List[str] = list(dict.fromkeys(e.text for e in sub_reader.events if len(e.text.strip()) != 0))
+
+        self._lock = threading.Lock()
+        self._done = 0
+        self._failed = 0
+        self._stopped = False
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        if self._executor is not None:
+            raise RuntimeError("Preanalysis was already started")
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        for i in range(0, len(self.texts), self.chunk_size):
+            self._executor.submit(self._analyze_chunk, self.texts[i:i + self.chunk_size])
+        self._executor.shutdown(wait=False)
+
+    def stop(self):
+        self._stopped = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _analyze_chunk(self, chunk: List[str]):
+        for text in chunk:
+            if self._stopped:
+                return
+            failed = False
+            try:
+                self.ichi_reader.analyze(text)
+            except Exception:
+                # Any failure must still count the line as done, or the progress never reaches the total
+                failed = True
+            with self._lock:
+                self._done += 1
+                if failed:
+                    self._failed += 1
+
+    def progress(self) -> Dict[str, int]:
+        with self._lock:
+            return {"done": self._done, "failed": self._failed, "total": len(self.texts)}
+
+    def is_finished(self) -> bool:
+        with self._lock:
+            return self._done == len(self.texts)
@@ -1,7 +1,7 @@
-import re
 from typing import Dict, Any
 
 from reader.statistics.generic_statistic_reader import StatsReader
+from utils import is_kanji
 
 
 class KanjiStatsReader(StatsReader):
@@ -12,7 +12,7 @@ class KanjiStatsReader(StatsReader):
     def process_file(self, file_data: str) -> Dict[Any, int]:
         rt = {}
         for c in file_data:
-            if re.match('[\u3400-\u4DB5\u4E00-\u9FCB\uF900-\uFA6A]$', c):
+            if is_kanji(c):
                 if c not in rt:
                     rt[c] = 0
                 rt[c] += 1
@@ -0,0 +1,97 @@
+import heapq
+from typing import Dict, List, Tuple
+
+from reader.subtitle_reader import GenericReader, SubtitleEvent
+
+
+class AlignedEvent:
+
+    def __init__(self, position: int, event: SubtitleEvent, overlap: float, ratio: float):
+        """
+
+        :param position: The position of the event in the events of the reader it came from.
+        :param event: The matched event.
+        :param overlap: The length (in seconds) of the time both events are shown together.
+        :param ratio: The overlap as a part of the length of the event that was matched against.
+        """
+        self.position = position
+        self.event = event
+        self.overlap = overlap
+        self.ratio = ratio
+
+    def __repr__(self):
+        return f"{self.ratio:.2f} {self.event}"
+
+
+class SubtitleAlignment:
+    """
+    Joins the events of two readers (e.g. Japanese and English subtitles of the same video) by time. The whole
+    mapping is computed once with a sweep over both event lists sorted by start time, so matching a line is a lookup.
+    """
+
+    def __init__(self, source: GenericReader, target: GenericReader):
+        self.source_events = source.events
+        self.target_events = target.events
+        self.by_source: List[List[AlignedEvent]] = [[] for _ in range(len(self.source_events))]
+        self._source_positions: Dict[Tuple[float, float, str], int] = dict()
+        for i, event in enumerate(self.source_events):
+            self._source_positions.setdefault(self._key(event), i)
+        self._sweep()
+
+    @staticmethod
+    def _key(event: SubtitleEvent) -> Tuple[float, float, str]:
+        return event.t0, event.t1, event.text
+
+    def _sweep(self):
+        source_t0s, source_t1s = self.source_events.t0s, self.source_events.t1s
+        target_t0s, target_t1s = self.target_events.t0s, self.target_events.t1s
+        source_order = sorted(range(len(source_t0s)), key=source_t0s.__getitem__)
+        target_order = sorted(range(len(target_t0s)), key=target_t0s.__getitem__)
+
+        # Target events that started by the start of the current source event, by their end time. Targets are only
+        # added by start time (and not by the end of a source event, which may be long), so every target left in
+        # here after dropping the ended ones intersects the current source event
+        active: List[Tuple[float, int]] = []
+        next_target = 0
+        for i in source_order:
+            s_t0, s_t1 = source_t0s[i], source_t1s[i]
+            while next_target < len(target_order) and target_t0s[target_order[next_target]] <= s_t0:
+                j = target_order[next_target]
+                heapq.heappush(active, (target_t1s[j], j))
+                next_target += 1
+            # Source events are visited by start time, so whatever ended before this one started is done with
+            while len(active) != 0 and active[0][0] < s_t0:
+                heapq.heappop(active)
+
+            matched = [j for _, j in active]
+            # Targets starting while the source event is shown, looked at without being added
+            ahead = next_target
+            while ahead < len(target_order) and target_t0s[target_order[ahead]] <= s_t1:
+                matched.append(target_order[ahead])
+                ahead += 1
+
+            duration = s_t1 - s_t0
+            for j in sorted(matched):
+                overlap = min(s_t1, target_t1s[j]) - max(s_t0, target_t0s[j])
+                ratio = overlap / duration if duration > 0 else 1.0
+                self.by_source[i].append(AlignedEvent(j, self.target_events[j], overlap, ratio))
+
+    def matches(self, event: SubtitleEvent) -> List[AlignedEvent]:
+        """
+        :param event: An event of the source reader.
+        :return: All the target events that intersect it, in the order of the target file.
+        """
+        position = self._source_positions.get(self._key(event))
+        if position is None:
+            raise ValueError(f"{event} is not an event of the source subtitles")
+        return self.by_source[position]
+
+    def pairs(self) -> List[Tuple[int, int, float]]:
+        """
+        :return: All the matches as (source position, target position, overlap ratio).
+        """
+        rt = []
+        for i, matches in enumerate(self.by_source):
+            for match in matches:
+                rt.append((i, match.position, match.ratio))
+        return rt
@@ -0,0 +1,151 @@
+import array
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple, Iterable, Any
+
+from utils import compute_file_hash, json_t
+
+
+class SubtitleCache:
+    """
+    An on-disk cache of parsed subtitle files. Each file's events are stored in a compact binary table named by the
+    sha256 of the file's content. A small json index maps every file path to its size, mtime and sha so unchanged
+    files don't need to be hashed again.
+
+    Table layout (little endian): magic, version, event count, all start times (doubles), all end times (doubles),
+    the end offset of every text (unsigned 64 bit) and finally all the texts as one utf-8 buffer.
+    """
+    MAGIC = b"AMSC"
+    VERSION = 1
+    HEADER = struct.Struct("<4sII")
+    INDEX_FILE = "index.json"
+    TABLE_EXTENSION = ".bin"
+
+    def __init__(self, cache_dir: str):
+        if os.path.exists(cache_dir) and not os.path.isdir(cache_dir):
+            raise ValueError(f"{cache_dir} exists but isn't a directory")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self._index_path = os.path.join(cache_dir, self.INDEX_FILE)
+        self._index: Dict[str, json_t] = self._load_index()
+        self._index_lock = threading.Lock()
+
+    def _load_index(self) -> Dict[str, json_t]:
+        if not os.path.isfile(self._index_path):
+            return dict()
+        try:
+            with open(self._index_path, "r", encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write_file(self, path: str, data: bytes):
+        """
+        Replaces the file at once with the data. The temporary file has a unique name, since other threads or miners
+        using the same cache may be writing the same file.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _file_sha(self, sub_file: str) -> str:
+        """
+        :return: The sha256 of the file, taken from the index if the file's size and mtime didn't change.
+        """
+        key = os.path.abspath(sub_file)
+        stat = os.stat(sub_file)
+        entry = self._index.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha"]
+
+        sha = compute_file_hash(sub_file)
+        with self._index_lock:
+            self._index[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha": sha}
+            self._write_file(self._index_path, json.dumps(self._index).encode('utf-8'))
+        return sha
+
+    def _table_path(self, sha: str) -> str:
+        return os.path.join(self.cache_dir, sha + self.TABLE_EXTENSION)
+
+    def load(self, sub_file: str) -> Optional[Tuple[array.array, array.array, List[str]]]:
+        """
+        :return: The cached start time, end time and text columns of the given subtitle file, or None if the file
+            isn't cached or the cached table can't be used.
+        """
+        table_path = self._table_path(self._file_sha(sub_file))
+        if not os.path.isfile(table_path):
+            return None
+        with open(table_path, "rb") as f:
+            data = f.read()
+        try:
+            return self._decode(data)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            return None
+
+    def store(self, sub_file: str, events: Iterable[Any]):
+        """
+        Stores the events parsed from the given file. Events are anything with `t0`, `t1` and `text` attributes.
+        """
+        self._write_file(self._table_path(self._file_sha(sub_file)), self._encode(events))
+
+    @staticmethod
+    def _to_little_endian(arr: array.array) -> array.array:
+        if sys.byteorder != "little":
+            arr.byteswap()
+        return arr
+
+    @classmethod
+    def _encode(cls, events: Iterable[Any]) -> bytes:
+        t0s = array.array("d")
+        t1s = array.array("d")
+        ends = array.array("Q")
+        texts = []
+        offset = 0
+        for event in events:
+            encoded = event.text.encode("utf-8")
+            t0s.append(event.t0)
+            t1s.append(event.t1)
+            offset += len(encoded)
+            ends.append(offset)
+            texts.append(encoded)
+
+        return b"".join([cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(t0s)),
+                         cls._to_little_endian(t0s).tobytes(),
+                         cls._to_little_endian(t1s).tobytes(),
+                         cls._to_little_endian(ends).tobytes()] + texts)
+
+    @classmethod
+    def _decode(cls, data: bytes) -> Tuple[array.array, array.array, List[str]]:
+        magic, version, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("Not a subtitle table of the current version")
+
+        columns = []
+        pos = cls.HEADER.size
+        for type_code in ("d", "d", "Q"):
+            column = array.array(type_code)
+            size = column.itemsize * count
+            column.frombytes(data[pos:pos + size])
+            columns.append(cls._to_little_endian(column))
+            pos += size
+        t0s, t1s, ends = columns
+
+        text_buffer = data[pos:]
+        if len(ends) != count or (count != 0 and ends[-1] != len(text_buffer)):
+            raise ValueError("Subtitle table is truncated")
+
+        texts = []
+        start = 0
+        for end in ends:
+            texts.append(text_buffer[start:end].decode("utf-8"))
+            start = end
+        return t0s, t1s, texts
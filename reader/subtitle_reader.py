@@ -1,8 +1,10 @@
+import array
 import json
 import os
 import re
-from typing import List, Optional, Tuple, Union
+from typing import List, Optional, Union, Sequence, Iterable, Iterator, Dict
 
+from reader.subtitle_cache import SubtitleCache
 from utils import parse_timestamp
 
 
@@ -25,6 +27,7 @@ def align(value: str, size: int) -> str:
 
 
 class SubtitleEvent:
+    __slots__ = ("t0", "t1", "text")
 
     @staticmethod
     def fix_whitespace(txt: str) -> str:
@@ -35,19 +38,18 @@ class SubtitleEvent:
         rt = rt.replace('  ', ' ')
         return rt
 
-    def __init__(self, t0: float, t1: float, text: str):
+    def __init__(self, t0: float, t1: float, text: str, fix_text: bool = True):
         if min(t0, t1) < 0 or t1 < t0:
             raise ValueError(f"{t0}-{t1} is invalid as a timestamp")
         self.t0 = t0
         self.t1 = t1
-        self.text = self.fix_whitespace(text)
+        self.text = self.fix_whitespace(text) if fix_text else text
 
     def is_within(self, t: float) -> bool:
         return self.t0 <= t <= self.t1
 
     def intersects(self, other: "SubtitleEvent"):
-        return any([self.is_within(other.t0), self.is_within(other.t1),
-                    other.is_within(self.t0), other.is_within(self.t1)])
+        return self.t0 <= other.t1 and other.t0 <= self.t1
 
     def __str__(self):
         return align(f"{timestamp_to_str(self.t0)} - {timestamp_to_str(self.t1)}", 32) + self.text
@@ -66,6 +68,137 @@ class SubtitleEvent:
         return json.dumps(self.to_js())
 
 
+class EventTable:
+    """
+    Columnar storage for the events of a subtitle file. Start and end times are kept in two `array` columns, and the
+    texts are interned into one buffer (identical lines are stored once) with an id column pointing into it.
+    `SubtitleEvent` objects are only created when an event is accessed.
+    """
+
+    def __init__(self, events: Iterable[SubtitleEvent] = ()):
+        self.t0s = array.array("d")
+        self.t1s = array.array("d")
+        self.text_ids = array.array("L")
+        self._text_starts = array.array("Q", [0])
+        self._text_buffer = ""
+
+        parts = []
+        interned: Dict[str, int] = dict()
+        for event in events:
+            self._append(event.t0, event.t1, event.text, parts, interned)
+        self._text_buffer = "".join(parts)
+
+    @classmethod
+    def from_columns(cls, t0s: Iterable[float], t1s: Iterable[float], texts: Iterable[str]) -> "EventTable":
+        """
+        Builds a table from already validated columns, e.g. ones loaded from a `SubtitleCache`.
+        """
+        rt = cls()
+        parts = []
+        interned: Dict[str, int] = dict()
+        for t0, t1, text in zip(t0s, t1s, texts):
+            rt._append(t0, t1, text, parts, interned)
+        rt._text_buffer = "".join(parts)
+        return rt
+
+    def _append(self, t0: float, t1: float, text: str, parts: List[str], interned: Dict[str, int]):
+        text_id = interned.get(text)
+        if text_id is None:
+            text_id = len(interned)
+            interned[text] = text_id
+            parts.append(text)
+            self._text_starts.append(self._text_starts[-1] + len(text))
+        self.t0s.append(t0)
+        self.t1s.append(t1)
+        self.text_ids.append(text_id)
+
+    def __len__(self):
+        return len(self.t0s)
+
+    def text(self, i: int) -> str:
+        text_id = self.text_ids[i]
+        return self._text_buffer[self._text_starts[text_id]:self._text_starts[text_id + 1]]
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[SubtitleEvent, List[SubtitleEvent]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return SubtitleEvent(self.t0s[i], self.t1s[i], self.text(i), fix_text=False)
+
+    def __iter__(self) -> Iterator[SubtitleEvent]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def within(self, t0: float, t1: float) -> List[int]:
+        """
+        :return: The positions of all the events that are shown entirely within [t0, t1].
+        """
+        return [i for i, (e_t0, e_t1) in enumerate(zip(self.t0s, self.t1s)) if t0 <= e_t0 and e_t1 <= t1]
+
+    def longer_than(self, seconds: float) -> List[int]:
+        """
+        :return: The positions of all the events that are shown for more than the given amount of seconds.
+        """
+        return [i for i, (e_t0, e_t1) in enumerate(zip(self.t0s, self.t1s)) if e_t1 - e_t0 > seconds]
+
+    def durations(self) -> array.array:
+        return array.array("d", [e_t1 - e_t0 for e_t0, e_t1 in zip(self.t0s, self.t1s)])
+
+
+class SubtitleIndex:
+    """
+    A static interval tree over the (t0, t1) ranges of a list of events. The events are sorted by their start time
+    and laid out as an implicit balanced binary tree (the middle of every range is its root), where every root also
+    keeps the latest end time in its subtree. This allows overlap queries in O(log n + k).
+    """
+
+    def __init__(self, t0s: Sequence[float], t1s: Sequence[float]):
+        if len(t0s) != len(t1s):
+            raise ValueError("Start and end times don't have the same length")
+        # Sorting is stable, so events with the same start time keep their original order
+        self.order = array.array("L", sorted(range(len(t0s)), key=t0s.__getitem__))
+        self.t0s = array.array("d", [t0s[i] for i in self.order])
+        self.t1s = array.array("d", [t1s[i] for i in self.order])
+        self.max_t1s = array.array("d", self.t1s)
+        self._build(0, len(self.order))
+
+    def _build(self, lo: int, hi: int) -> float:
+        if lo >= hi:
+            return -1.0
+        mid = (lo + hi) // 2
+        self.max_t1s[mid] = max(self.t1s[mid], self._build(lo, mid), self._build(mid + 1, hi))
+        return self.max_t1s[mid]
+
+    def __len__(self):
+        return len(self.order)
+
+    def overlapping(self, t0: float, t1: float) -> List[int]:
+        """
+        :return: The original positions (in ascending order) of all the events that intersect the range [t0, t1].
+        """
+        if t1 < t0:
+            raise ValueError(f"{t0}-{t1} is invalid as a range")
+        rt = []
+        self._collect(0, len(self.order), t0, t1, rt)
+        rt.sort()
+        return rt
+
+    def _collect(self, lo: int, hi: int, t0: float, t1: float, rt: List[int]):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.max_t1s[mid] < t0:
+                return
+            self._collect(lo, mid, t0, t1, rt)
+            # Everything to the right starts after this event, so nothing there can intersect the range either
+            if self.t0s[mid] > t1:
+                return
+            if self.t1s[mid] >= t0:
+                rt.append(self.order[mid])
+            lo = mid + 1
+
+
 class GenericReader:
 
     def __init__(self, sub_file: str):
@@ -83,8 +216,21 @@ class GenericReader:
             timestamp = SubtitleEvent(t0=timestamp, t1=timestamp, text="")
         return self._get_all_lines_and_time_ranges(timestamp)
 
+    def events_between(self, t0: float, t1: float) -> List[SubtitleEvent]:
+        """
+        :return: All the events that intersect the time range [t0, t1] (edges included).
+        """
+        return self._get_all_lines_and_time_ranges(SubtitleEvent(t0=t0, t1=t1, text=""))
+
+    def _set_events(self, events: Iterable[SubtitleEvent]):
+        """
+        Stores the parsed events of the file in an `EventTable` and builds the time index used to answer queries.
+        """
+        self.events = events if isinstance(events, EventTable) else EventTable(events)
+        self.index = SubtitleIndex(self.events.t0s, self.events.t1s)
+
     def _get_all_lines_and_time_ranges(self, timestamp: SubtitleEvent) -> List[SubtitleEvent]:
-        raise RuntimeError("Not Implemented")
+        return [self.events[i] for i in self.index.overlapping(timestamp.t0, timestamp.t1)]
 
 
 class SrtReader(GenericReader):
@@ -92,44 +238,38 @@ class SrtReader(GenericReader):
     def __init__(self, sub_file: str):
         super().__init__(sub_file)
 
-        self.events: List[SubtitleEvent] = []
-
         with open(sub_file, "r", encoding='utf-8') as f:
-            lines = f.read().splitlines()
-
-        while len(lines) != 0:
-            lines, to_add = self.parse_sub(lines, len(self.events))
-            self.events.append(to_add)
+            self._set_events(self.iter_events(f))
 
     @staticmethod
-    def parse_sub(lines: List[str], prev_index: int) -> Tuple[List[str], SubtitleEvent]:
-        if len(lines) < 3:
-            raise RuntimeError("Not enough lines for subtitle line")
-
-        # ind = lines[0].strip()
-        # print(ind[0], len(ind))
-        # assert ind.isnumeric(), "Index wasn't numeric"
-        # ind = int(ind)
-        # assert ind == prev_index + 1, "Missed an index"
-
-        start, arrow, end = lines[1].partition("-->")
-        assert arrow == "-->", "Time range has no end time"
-        start_t = SrtReader.parse_srt_timestamp(start.strip())
-        end_t = SrtReader.parse_srt_timestamp(end.strip())
-        assert end_t >= start_t, "end time was before start time"
-
-        line_count = 0
-        total_sub = ""
-        for line in lines[2:]:
-            line = line.strip()
-            if len(line) == 0:
-                break
-            line_count += 1
-            if len(total_sub) != 0:
-                total_sub += "\n"
-            total_sub += line
-
-        return lines[3 + line_count:], SubtitleEvent(start_t, end_t, total_sub)
+    def iter_events(lines: Iterable[str]) -> Iterator[SubtitleEvent]:
+        """
+        Parses subtitle events one at a time in a single pass over the given lines (e.g. an open file handle).
+        Every event is an index line, a time range line and the text lines, up to an empty line or the end of input.
+        """
+        lines = iter(lines)
+        for _index_line in lines:
+            # ind = _index_line.strip()
+            # assert ind.isnumeric(), "Index wasn't numeric"
+
+            time_line = next(lines, None)
+            first_line = next(lines, None)
+            if time_line is None or first_line is None:
+                raise RuntimeError("Not enough lines for subtitle line")
+
+            start, arrow, end = time_line.partition("-->")
+            assert arrow == "-->", "Time range has no end time"
+            start_t = SrtReader.parse_srt_timestamp(start.strip())
+            end_t = SrtReader.parse_srt_timestamp(end.strip())
+            assert end_t >= start_t, "end time was before start time"
+
+            text_lines = []
+            line = first_line.strip()
+            while len(line) != 0:
+                text_lines.append(line)
+                line = next(lines, "").strip()
+
+            yield SubtitleEvent(start_t, end_t, "\n".join(text_lines))
 
     @staticmethod
     def parse_srt_timestamp(stamp: str):
@@ -139,9 +279,6 @@ class SrtReader(GenericReader):
     def get_allowed_extensions() -> List[str]:
         return [".srt"]
 
-    def _get_all_lines_and_time_ranges(self, timestamp: SubtitleEvent) -> List[SubtitleEvent]:
-        return list(filter(lambda e: e.intersects(timestamp), self.events))
-
 
 class AssReader(GenericReader):
     ASS_HEADER_OPENER = "["
@@ -165,8 +302,9 @@ class AssReader(GenericReader):
         self.event_starts = self.get_all_section_starts(self.ASS_EVENTS_HEADER)
         self.event_ends = list(map(lambda i: self.get_section_end_by_start(i), self.event_starts))
 
-    def _get_all_lines_and_time_ranges(self, timestamp: SubtitleEvent) -> List[SubtitleEvent]:
-        rt_list = []
+        self._set_events(self.parse_events())
+
+    def parse_events(self) -> Iterator[SubtitleEvent]:
         for start, end in zip(self.event_starts, self.event_ends):
             if end <= start + 1:
                 raise RuntimeError("No format line available")
@@ -187,10 +325,8 @@ class AssReader(GenericReader):
                                                    t0,
                                                    t1,
                                                    len(splat))
-                if event is not None and event.intersects(timestamp):
-                    rt_list.append(event)
-
-        return rt_list
+                if event is not None:
+                    yield event
 
     def get_all_section_starts(self, header: str) -> List[int]:
         rt = []
@@ -249,13 +385,39 @@ class AssReader(GenericReader):
         return [".ass"]
 
 
+class CachedReader(GenericReader):
+    """
+    A reader over events that were already parsed from the file, e.g. loaded from a `SubtitleCache`.
+    """
+
+    def __init__(self, sub_file: str, events: Iterable[SubtitleEvent]):
+        super().__init__(sub_file)
+        self._set_events(events)
+
+    @staticmethod
+    def get_allowed_extensions() -> List[str]:
+        return MasterReader.get_allowed_extensions()
+
+
 class MasterReader(GenericReader):
     _all_readers = (SrtReader, AssReader)
 
-    def __init__(self, sub_file: str):
+    def __init__(self, sub_file: str, cache: Optional[SubtitleCache] = None):
+        """
+
+        :param sub_file: The subtitle file to read.
+        :param cache: When given, the parsed events are loaded from the cache if the file didn't change, and stored
+            in it after parsing otherwise.
+        """
         super().__init__(sub_file)
         ext = os.path.splitext(sub_file)[1]
         self.worker = None
+
+        cached = cache.load(sub_file) if cache is not None else None
+        if cached is not None:
+            self.worker = CachedReader(sub_file, EventTable.from_columns(*cached))
+            return
+
         for reader in self._all_readers:
             if ext in reader.get_allowed_extensions():
                 self.worker = reader(sub_file)
@@ -263,6 +425,13 @@ class MasterReader(GenericReader):
         if self.worker is None:
             raise RuntimeError("This is not supposed to happen....")
 
+        if cache is not None:
+            cache.store(sub_file, self.worker.events)
+
+    @property
+    def events(self) -> EventTable:
+        return self.worker.events
+
     @staticmethod
     def get_allowed_extensions() -> List[str]:
         rt = []
@@ -270,6 +439,9 @@ class MasterReader(GenericReader):
             rt += r.get_allowed_extensions()
         return rt
 
+    def events_between(self, t0: float, t1: float) -> List[SubtitleEvent]:
+        return self.worker.events_between(t0, t1)
+
     def _get_all_lines_and_time_ranges(self, timestamp: SubtitleEvent) -> List[SubtitleEvent]:
         return self.worker.get_all_lines_and_time_ranges(timestamp)
 
@@ -1,49 +1,324 @@
 import os
 import pathlib
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Dict, Any, Iterable, List, Tuple
 
 import moviepy.editor as movp
+from moviepy.config import get_setting
+import numpy as np
+from PIL import Image
 
+from reader.frame_grabber import FrameGrabber
 from utils import generate_random_file_name
 
 
+class AudioProfile:
+    """
+    How extracted audio is encoded. The default is uncompressed wav, compressed formats with a low bitrate, in mono
+    and downsampled are many times smaller and are more than enough for a line of speech.
+    """
+    # format -> (file extension, ffmpeg codec)
+    FORMATS = {
+        "wav": (".wav", "pcm_s16le"),
+        "mp3": (".mp3", "libmp3lame"),
+        "ogg": (".ogg", "libopus"),
+    }
+    # libopus only encodes these sample rates
+    OPUS_SAMPLE_RATES = [8000, 12000, 16000, 24000, 48000]
+
+    def __init__(self, audio_format: str = "wav", bitrate: Optional[str] = None, mono: bool = False,
+                 sample_rate: int = 44100):
+        """
+
+        :param audio_format: One of `FORMATS`.
+        :param bitrate: The bitrate given to ffmpeg (e.g. "64k"), ignored for wav. None to use ffmpeg's default.
+        :param mono: Whether to mix the audio down into a single channel.
+        :param sample_rate: The sample rate of the output in Hz.
+        """
+        if audio_format not in self.FORMATS:
+            raise ValueError(f"audio format {audio_format} isn't one of {list(self.FORMATS.keys())}")
+        if audio_format == "ogg" and sample_rate not in self.OPUS_SAMPLE_RATES:
+            raise ValueError(f"ogg (opus) audio must have one of the sample rates {self.OPUS_SAMPLE_RATES}")
+        if sample_rate <= 0:
+            raise ValueError(f"sample rate must be positive, got {sample_rate}")
+        self.audio_format = audio_format
+        self.extension, self.codec = self.FORMATS[audio_format]
+        self.bitrate = bitrate if audio_format != "wav" else None
+        self.mono = mono
+        self.sample_rate = sample_rate
+
+    @staticmethod
+    def from_config(section: Dict[str, Any]) -> "AudioProfile":
+        """
+        :param section: The `[audio]` section of the config, with the keys `format`, `bitrate`, `mono` and
+            `sample_rate`. Missing keys keep their defaults.
+        """
+        audio_format = section.get("format", "wav")
+        default_rate = 48000 if audio_format == "ogg" else 44100
+        return AudioProfile(audio_format, section.get("bitrate"), section.get("mono", False),
+                            section.get("sample_rate", default_rate))
+
+    def ffmpeg_params(self):
+        return ["-ac", "1"] if self.mono else None
+
+    def ffmpeg_output_args(self) -> List[str]:
+        """
+        :return: The ffmpeg output options that encode audio with this profile.
+        """
+        args = ["-c:a", self.codec, "-ar", str(self.sample_rate)]
+        if self.bitrate is not None:
+            args += ["-b:a", self.bitrate]
+        if self.mono:
+            args += ["-ac", "1"]
+        return args
+
+
+class ImageProfile:
+    """
+    How extracted frames are encoded. The default is a full resolution png, a jpg or webp scaled down to the size it
+    is shown at in a card is many times smaller.
+    """
+    # format -> (file extension, PIL format)
+    FORMATS = {
+        "png": (".png", "PNG"),
+        "jpg": (".jpg", "JPEG"),
+        "webp": (".webp", "WEBP"),
+    }
+
+    def __init__(self, image_format: str = "png", quality: int = 80, max_dimension: Optional[int] = None):
+        """
+
+        :param image_format: One of `FORMATS`.
+        :param quality: The quality of lossy formats, between 1 and 100. Ignored for png.
+        :param max_dimension: When given, images are scaled down (keeping their aspect ratio) so neither their width
+            nor their height is larger than this.
+        """
+        if image_format not in self.FORMATS:
+            raise ValueError(f"image format {image_format} isn't one of {list(self.FORMATS.keys())}")
+        if not 1 <= quality <= 100:
+            raise ValueError(f"quality must be between 1 and 100, got {quality}")
+        if max_dimension is not None and max_dimension <= 0:
+            raise ValueError(f"max dimension must be positive, got {max_dimension}")
+        self.image_format = image_format
+        self.extension, self.pil_format = self.FORMATS[image_format]
+        self.quality = quality
+        self.max_dimension = max_dimension
+
+    @staticmethod
+    def from_config(section: Dict[str, Any]) -> "ImageProfile":
+        """
+        :param section: The `[image]` section of the config, with the keys `format`, `quality` and `max_dimension`.
+            Missing keys keep their defaults.
+        """
+        return ImageProfile(section.get("format", "png"), section.get("quality", 80), section.get("max_dimension"))
+
+    def save(self, frame, file_name: pathlib.Path):
+        """
+        :param frame: A frame as returned by moviepy (an array of RGB values).
+        :param file_name: Where to save the image.
+        """
+        image = Image.fromarray(frame)
+        if self.max_dimension is not None:
+            image.thumbnail((self.max_dimension, self.max_dimension), Image.Resampling.LANCZOS)
+        if self.image_format == "png":
+            image.save(file_name, self.pil_format, optimize=True)
+        else:
+            image.save(file_name, self.pil_format, quality=self.quality)
+
+
+media_request = Tuple[str, float, float]
+
+
+def _extract_segment(video_loc: str, save_loc: str, audio_profile: AudioProfile, image_profile: ImageProfile,
+                     index_dir: Optional[str], requests: List[media_request]) -> Dict[media_request, pathlib.Path]:
+    """
+    Runs a part of `VideoReader.extract_batch` in a worker process.
+    """
+    reader = VideoReader(video_loc, save_loc, audio_profile, image_profile, index_dir)
+    try:
+        return reader._extract_sorted(requests)
+    finally:
+        reader.frames.close()
+        reader.vid.close()
+
+
 class VideoReader:
     ALLOWED_VIDEO_FILES = [".mkv", ".mp4"]
-    AUDIO_OUT = ".wav"
-    IMAGE_OUT = ".png"
+    AUDIO = "audio"
+    IMAGE = "image"
+    # The amount of audio clips encoded by a single ffmpeg run, which decodes the audio between them once
+    MAX_AUDIO_OUTPUTS = 32
+
+    def __init__(self, video_loc: str, save_loc="", audio_profile: Optional[AudioProfile] = None,
+                 image_profile: Optional[ImageProfile] = None, index_dir: Optional[str] = None):
+        """
 
-    def __init__(self, video_loc: str, save_loc=""):
+        :param video_loc: The video file.
+        :param save_loc: Where extracted files are saved.
+        :param audio_profile: How extracted audio is encoded, uncompressed wav by default.
+        :param image_profile: How extracted images are encoded, full resolution png by default.
+        :param index_dir: A directory to cache the keyframe indexes of videos in. See `FrameGrabber`.
+        """
         if not os.path.isfile(video_loc):
             raise ValueError(f"no file at path {video_loc}")
         if os.path.splitext(video_loc)[1] not in self.ALLOWED_VIDEO_FILES:
             raise ValueError(f"file type is {os.path.splitext(video_loc)[1]} and not allowed video type")
 
+        self.video_loc = video_loc
+        self.index_dir = index_dir
         self.vid = movp.VideoFileClip(video_loc)
+        self.frames = FrameGrabber(video_loc, index_dir)
         if len(save_loc) == "":
             self.path_to_use = pathlib.Path(os.getcwd()).parent
         else:
             self.path_to_use = pathlib.Path(save_loc)
+        self.audio_profile = audio_profile if audio_profile is not None else AudioProfile()
+        self.image_profile = image_profile if image_profile is not None else ImageProfile()
         self.my_files = []
+        # Files are extracted and discarded from multiple threads
+        self._files_lock = threading.Lock()
 
     def extract_audio(self, sec_start: float, sec_end: float) -> pathlib.Path:
         if sec_start < 0 or sec_start >= sec_end or sec_end > self.vid.duration:
             raise ValueError(f"Invalid timestamp {sec_end}-{sec_end}")
-        file_name = generate_random_file_name(self.path_to_use, self.AUDIO_OUT)
-        self.vid.audio.subclip(sec_start, sec_end).write_audiofile(file_name)
-        self.my_files.append(file_name)
+        file_name = generate_random_file_name(self.path_to_use, self.audio_profile.extension)
+        self.vid.audio.subclip(sec_start, sec_end).write_audiofile(
+            str(file_name), fps=self.audio_profile.sample_rate, codec=self.audio_profile.codec,
+            bitrate=self.audio_profile.bitrate, ffmpeg_params=self.audio_profile.ffmpeg_params())
+        with self._files_lock:
+            self.my_files.append(file_name)
         return file_name
 
+    def get_frame(self, timestamp: float) -> np.ndarray:
+        """
+        :return: The frame shown at the timestamp as an array, see `FrameGrabber.get_frame`.
+        """
+        if timestamp < 0 or timestamp > self.vid.duration:
+            raise ValueError(f"Invalid timestamp {timestamp}")
+        return self.frames.get_frame(timestamp)
+
     def extract_image(self, image_timestamp: float) -> pathlib.Path:
-        if image_timestamp < 0 or image_timestamp > self.vid.duration:
-            raise ValueError(f"Invalid timestamp {image_timestamp}")
-        file_name = generate_random_file_name(self.path_to_use, self.IMAGE_OUT)
-        self.vid.save_frame(file_name, t=image_timestamp)
-        self.my_files.append(file_name)
+        frame = self.get_frame(image_timestamp)
+        file_name = generate_random_file_name(self.path_to_use, self.image_profile.extension)
+        self.image_profile.save(frame, file_name)
+        with self._files_lock:
+            self.my_files.append(file_name)
         return file_name
 
+    def extract_batch(self, requests: List[media_request], processes: int = 0) -> Dict[media_request, pathlib.Path]:
+        """
+        Extracts many images and audio clips in one forward pass over the video, instead of seeking and decoding for
+        every one of them.
+        :param requests: Tuples of (kind, t0, t1). The kind is `AUDIO` for the audio from t0 to t1, or `IMAGE` for
+            the frame shown at t0 (t1 is ignored).
+        :param processes: When more than 1, the requests are split by time into this many parts, extracted in
+            parallel worker processes.
+        :return: The extracted file of every request.
+        """
+        for kind, t0, t1 in requests:
+            if kind == self.AUDIO:
+                if t0 < 0 or t0 >= t1 or t1 > self.vid.duration:
+                    raise ValueError(f"Invalid timestamp {t0}-{t1}")
+            elif kind == self.IMAGE:
+                if t0 < 0 or t0 > self.vid.duration:
+                    raise ValueError(f"Invalid timestamp {t0}")
+            else:
+                raise ValueError(f"Unknown media kind {kind}, expected {self.AUDIO} or {self.IMAGE}")
+
+        ordered = sorted(set(requests), key=lambda request: (request[1], request[2]))
+        if processes <= 1 or len(ordered) < 2:
+            results = self._extract_sorted(ordered)
+        else:
+            segment_size = -(-len(ordered) // processes)
+            results = dict()
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = [pool.submit(_extract_segment, self.video_loc, str(self.path_to_use), self.audio_profile,
+                                       self.image_profile, self.index_dir, ordered[i:i + segment_size])
+                           for i in range(0, len(ordered), segment_size)]
+                failure = None
+                for future in futures:
+                    try:
+                        results.update(future.result())
+                    except Exception as e:
+                        failure = e if failure is None else failure
+            if failure is not None:
+                # A failed segment deletes its own files, the other segments' files are never returned
+                self._unlink_all(results.values())
+                raise failure
+        with self._files_lock:
+            self.my_files.extend(results.values())
+        return results
+
+    def _extract_sorted(self, requests: List[media_request]) -> Dict[media_request, pathlib.Path]:
+        results = dict()
+        try:
+            images: Dict[float, List[media_request]] = dict()
+            for request in requests:
+                if request[0] == self.IMAGE:
+                    images.setdefault(request[1], []).append(request)
+            for t, frame in self.frames.iter_frames(images.keys()):
+                for request in images[t]:
+                    file_name = generate_random_file_name(self.path_to_use, self.image_profile.extension)
+                    results[request] = file_name
+                    self.image_profile.save(frame, file_name)
+
+            audio = [request for request in requests if request[0] == self.AUDIO]
+            for i in range(0, len(audio), self.MAX_AUDIO_OUTPUTS):
+                results.update(self._write_audio_clips(audio[i:i + self.MAX_AUDIO_OUTPUTS]))
+        except Exception:
+            # The files of a failed batch are never returned (or added to my_files), so nothing else deletes them
+            self._unlink_all(results.values())
+            raise
+        return results
+
+    @staticmethod
+    def _unlink_all(files: Iterable[pathlib.Path]):
+        for file_name in files:
+            file_name.unlink(missing_ok=True)
+
+    def _write_audio_clips(self, requests: List[media_request]) -> Dict[media_request, pathlib.Path]:
+        """
+        Encodes all the clips with a single ffmpeg run. ffmpeg seeks to the first clip and decodes the audio once,
+        and every clip is cut out of the decoded audio before it is resampled and encoded.
+        """
+        start = requests[0][1]
+        trims = [f"[a{i}]atrim=start={t0 - start:.6f}:end={t1 - start:.6f},asetpts=PTS-STARTPTS[o{i}]"
+                 for i, (_, t0, t1) in enumerate(requests)]
+        split = "[0:a]asplit=" + str(len(requests)) + "".join(f"[a{i}]" for i in range(len(requests)))
+        cmd = [get_setting("FFMPEG_BINARY"), "-loglevel", "error", "-y", "-ss", "%.06f" % start, "-i", self.video_loc,
+               "-filter_complex", ";".join([split] + trims)]
+        results = dict()
+        for i, request in enumerate(requests):
+            file_name = generate_random_file_name(self.path_to_use, self.audio_profile.extension)
+            cmd += ["-map", f"[o{i}]"] + self.audio_profile.ffmpeg_output_args() + [str(file_name)]
+            results[request] = file_name
+
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                                encoding='utf-8')
+        if result.returncode != 0:
+            # ffmpeg may have written some of the clips before failing
+            self._unlink_all(results.values())
+            raise RuntimeError(f"extracting audio from {self.video_loc} failed: {result.stderr}")
+        return results
+
+    def discard(self, file_name: pathlib.Path):
+        """
+        Deletes a single extracted file, for files that turned out not to be needed.
+        """
+        with self._files_lock:
+            if file_name not in self.my_files:
+                return
+            self.my_files.remove(file_name)
+        file_name.unlink(missing_ok=True)
+
     def clear_everything(self):
-        for file in self.my_files:
-            file.unlink()
-        self.my_files = []
+        with self._files_lock:
+            files = self.my_files
+            self.my_files = []
+        for file in files:
+            file.unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
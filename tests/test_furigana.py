@@ -0,0 +1,28 @@
+import pytest
+
+from reader.furigana import align_furigana, to_anki_furigana
+
+
+def test_gaps_are_kept():
+    spans = [('猫', 'ねこ'), ('だ', None)]
+    assert to_anki_furigana(align_furigana('「猫 だ」', spans)) == '「 猫[ねこ] だ」'
+
+
+def test_normalized_span_replaces_source_text():
+    # ichiran returns full-width katakana for half-width input
+    spans = [('カワイイ', None), ('猫', 'ねこ'), ('だ', None)]
+    assert to_anki_furigana(align_furigana('ｶﾜｲｲ猫だ', spans, strict=False)) == 'カワイイ 猫[ねこ]だ'
+
+
+def test_normalized_full_width_digits():
+    spans = [('１', None), ('匹', 'ひき'), ('の', None), ('猫', 'ねこ')]
+    assert to_anki_furigana(align_furigana('1匹の猫', spans, strict=False)) == '１ 匹[ひき]の 猫[ねこ]'
+
+
+def test_unmatched_last_span_replaces_rest_of_text():
+    assert to_anki_furigana(align_furigana('猫だ', [('犬', 'いぬ')], strict=False)) == ' 犬[いぬ]'
+
+
+def test_strict_raises_on_unmatched_span():
+    with pytest.raises(RuntimeError):
+        align_furigana('猫だ', [('犬', 'いぬ')])
@@ -0,0 +1,79 @@
+import sys
+import time
+
+import pytest
+
+from reader.ichiran_pool import IchiranPool, IchiranWorkerError
+
+# Speaks the protocol of reader/ichiran_worker.lisp, with texts that make it misbehave
+FAKE_WORKER = """
+import json
+import os
+import sys
+import time
+
+# The pool talks utf-8 whatever the locale is
+sys.stdin.reconfigure(encoding='utf-8')
+sys.stdout.reconfigure(encoding='utf-8')
+for line in sys.stdin:
+    request = json.loads(line)
+    text = request["text"]
+    if text == "crash":
+        sys.exit(1)
+    if text == "hang":
+        time.sleep(60)
+    if text == "garbage":
+        print("not json", flush=True)
+        continue
+    if text == "fail":
+        answer = {"error": "no analysis"}
+    else:
+        answer = {"output": request["flags"] + " " + text + " " + str(os.getpid())}
+    print(json.dumps(answer, ensure_ascii=False), flush=True)
+"""
+
+
+@pytest.fixture
+def pool(tmp_path):
+    script = tmp_path / "fake_worker.py"
+    script.write_text(FAKE_WORKER, encoding='utf-8')
+    pool = IchiranPool([sys.executable, str(script)], size=1, timeout=2.0)
+    yield pool
+    pool.close()
+
+
+def _answer(pool, text):
+    flags, answered_text, pid = pool.run("-f", text).split(" ")
+    assert (flags, answered_text) == ("-f", text)
+    return pid
+
+
+def test_requests_are_answered_by_the_same_process(pool):
+    assert _answer(pool, "猫だ") == _answer(pool, "犬")
+
+
+def test_error_answer_keeps_the_worker(pool):
+    pid = _answer(pool, "猫")
+    with pytest.raises(RuntimeError) as raised:
+        pool.run("-f", "fail")
+    assert not isinstance(raised.value, IchiranWorkerError)
+    assert _answer(pool, "猫") == pid
+
+
+@pytest.mark.parametrize("text", ["crash", "hang", "garbage"])
+def test_broken_worker_is_restarted(pool, text):
+    pid = _answer(pool, "猫")
+    with pytest.raises(IchiranWorkerError):
+        pool.run("-f", text)
+    assert _answer(pool, "猫") != pid
+
+
+def test_stuck_worker_is_killed(pool):
+    # A request that took the only worker long ago and never gave it back
+    worker = pool._idle.get()
+    pool._busy[worker] = time.monotonic() - 10
+    start = time.monotonic()
+    with pytest.raises(IchiranWorkerError):
+        pool.run("-f", "猫")
+    assert time.monotonic() - start < 3 * pool.timeout
+    assert not worker.is_alive()
@@ -0,0 +1,37 @@
+import random
+
+from reader.subtitle_alignment import SubtitleAlignment
+from reader.subtitle_reader import EventTable
+
+
+class _Reader:
+
+    def __init__(self, times):
+        self.events = EventTable.from_columns([t0 for t0, _ in times], [t1 for _, t1 in times],
+                                              [f"line {i}" for i in range(len(times))])
+
+
+def _random_times(rng, n):
+    times = []
+    for _ in range(n):
+        t0 = rng.uniform(0, n * 1.5)
+        times.append((t0, t0 + rng.uniform(0, 4)))
+    # A sign shown for the whole video
+    times.insert(n // 2, (0.0, n * 2.0))
+    return times
+
+
+def test_matches_every_intersecting_event():
+    rng = random.Random(0)
+    for _ in range(10):
+        source, target = _random_times(rng, 150), _random_times(rng, 120)
+        alignment = SubtitleAlignment(_Reader(source), _Reader(target))
+        expected = [(i, j) for i, (s_t0, s_t1) in enumerate(source) for j, (t_t0, t_t1) in enumerate(target)
+                    if t_t0 <= s_t1 and t_t1 >= s_t0]
+        assert [(i, j) for i, j, _ in alignment.pairs()] == expected
+
+
+def test_overlap_ratio():
+    alignment = SubtitleAlignment(_Reader([(0.0, 4.0)]), _Reader([(1.0, 2.0), (3.0, 6.0), (5.0, 7.0)]))
+    assert [(match.position, match.overlap, match.ratio) for match in alignment.by_source[0]] == \
+           [(0, 1.0, 0.25), (1, 1.0, 0.25)]
@@ -1,7 +1,11 @@
+import asyncio
+import functools
 import hashlib
 import pathlib
 import random
-from typing import Union, Dict, List, Any, Tuple
+import threading
+import time
+from typing import Union, Dict, List, Any, Tuple, Iterable
 
 number = Union[float, int]
 json_value = Union[number, str, bool, List, Dict, None]
@@ -9,6 +13,18 @@ json_key = str
 json_t = Dict[json_key, json_value]
 
 
+# Unicode ranges of the CJK ideographs used as kanji
+_KANJI_RANGES = ((0x3400, 0x4DB5), (0x4E00, 0x9FCB), (0xF900, 0xFA6A))
+
+
+def is_kanji(c: str) -> bool:
+    code = ord(c)
+    for low, high in _KANJI_RANGES:
+        if low <= code <= high:
+            return True
+    return False
+
+
 def get_all_from_dict_list_by_value(dictio: List[Dict], key: Any, value: Any) -> List[Dict]:
     return list(filter(lambda a: key in a and a[key] == value, dictio))
 
@@ -21,6 +37,22 @@ def compute_file_hash(file_name: str) -> str:
     return hash_sha256.hexdigest()
 
 
+def compute_quick_file_hash(file_name: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    A hash of the size and the first and last `chunk_size` bytes of a file, to identify large files (e.g. videos)
+    without reading all of them.
+    """
+    hash_sha256 = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        size = f.seek(0, 2)
+        hash_sha256.update(str(size).encode('utf-8'))
+        f.seek(0)
+        hash_sha256.update(f.read(chunk_size))
+        f.seek(max(0, size - chunk_size))
+        hash_sha256.update(f.read(chunk_size))
+    return hash_sha256.hexdigest()
+
+
 def generate_random_file_name(location: pathlib.Path,
                               extension: str,
                               char_amount: int = 12,
@@ -38,6 +70,47 @@ def generate_random_file_name(location: pathlib.Path,
     raise RuntimeError(f"Tried {max_tries} names of length {char_amount} and couldn't find any non taken names")
 
 
+class TokenBucket:
+    """
+    A rate limiter allowing `rate` actions per second on average, with bursts of up to `capacity` actions.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f"Invalid rate {rate} or capacity {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_take(self) -> float:
+        """
+        Takes a token if one is available.
+        :return: 0 if a token was taken, otherwise how long to wait (in seconds) until one will be available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        wait = self._try_take()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._try_take()
+
+    async def acquire_async(self):
+        wait = self._try_take()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._try_take()
+
+
 class _Marker:
 
     def __init__(self,
@@ -50,19 +123,29 @@ class _Marker:
         self.base = base_value
         self.strict = strict
 
-    def parse(self, source: str) -> Tuple[str, float]:
-        substr = ""
-        for c in source:
-            if len(substr) == self.length:
-                break
-            if not c.isnumeric():
-                break
-            substr += c
+    def parse(self, source: str, start: int = 0) -> Tuple[int, float]:
+        """
+        Parses the marker from `source` starting at index `start`.
+        :return: The index right after the parsed marker and the value of the marker in seconds.
+        """
+        end = start
+        limit = min(len(source), start + self.length)
+        while end < limit and source[end].isnumeric():
+            end += 1
+
+        if end - start != self.length and self.strict:
+            raise ValueError(f"{source[start:]} is an invalid stamp")
+
+        return end, int(source[start:end]) * self.base
+
+
+class _InvalidDirective:
 
-        if len(substr) != self.length and self.strict:
-            raise ValueError(f"{source} is an invalid stamp")
+    def __init__(self, error: Exception):
+        self.error = error
 
-        return source[len(substr):], int(substr) * self.base
+    def parse(self, source: str, start: int = 0) -> Tuple[int, float]:
+        raise self.error
 
 
 _formats = {
@@ -74,33 +157,71 @@ _formats = {
 }
 
 
-def parse_timestamp(stamp: str, fmt: str) -> float:
-    curr = stamp
-    curr_f = fmt
-    total = 0
-    while len(curr) != 0:
-        if len(curr_f) == 0:
-            raise RuntimeError(f"Can't parse {stamp} for format {fmt}")
-
-        if curr_f[0] == '%':
+class _CompiledFormat:
+    """
+    A timestamp format split once into its steps - runs of literal characters and markers - so stamps can be parsed
+    by index instead of re-reading the format string for each one.
+    """
+
+    def __init__(self, fmt: str):
+        self.fmt = fmt
+        self.steps: List[Union[str, _Marker, _InvalidDirective]] = []
+        literal_start = 0
+        i = 0
+        while i < len(fmt):
+            if fmt[i] != '%':
+                i += 1
+                continue
+            if literal_start != i:
+                self.steps.append(fmt[literal_start:i])
+            if i + 1 >= len(fmt):
+                # Only an error if the stamp still has characters when this is reached
+                self.steps.append(_InvalidDirective(RuntimeError(f"Can't parse stamp for format {fmt}")))
+            elif fmt[i + 1] not in _formats:
+                self.steps.append(_InvalidDirective(KeyError(fmt[i + 1])))
+            else:
+                self.steps.append(_formats[fmt[i + 1]])
+            i += 2
+            literal_start = i
+        if literal_start < len(fmt):
+            self.steps.append(fmt[literal_start:])
+
+    def parse(self, stamp: str) -> float:
+        pos = 0
+        total = 0
+        for step in self.steps:
+            if pos == len(stamp):
+                raise RuntimeError(f"Can't parse {stamp} for format {self.fmt}")
+
+            if isinstance(step, str):
+                if not stamp.startswith(step, pos):
+                    raise RuntimeError(f"Can't parse {stamp} for format {self.fmt}")
+                pos += len(step)
+            else:
+                pos, to_add = step.parse(stamp, pos)
+                total += to_add
+
+        if pos != len(stamp):
+            raise RuntimeError(f"Can't parse {stamp} for format {self.fmt}")
+
+        return total
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_format(fmt: str) -> _CompiledFormat:
+    return _CompiledFormat(fmt)
 
-            if len(curr_f) <= 1:
-                raise RuntimeError(f"Can't parse {stamp} for format {fmt}")
-            curr, to_add = _formats[curr_f[1]].parse(curr)
-            total += to_add
-            curr_f = curr_f[2:]
 
-        else:
-            if curr[0] != curr_f[0]:
-                raise RuntimeError(f"Can't parse {stamp} for format {fmt}")
-
-            curr = curr[1:]
-            curr_f = curr_f[1:]
+def parse_timestamp(stamp: str, fmt: str) -> float:
+    return _compile_format(fmt).parse(stamp)
 
-    if len(curr_f) != 0:
-        raise RuntimeError(f"Can't parse {stamp} for format {fmt}")
 
-    return total
+def parse_timestamps(stamps: Iterable[str], fmt: str) -> List[float]:
+    """
+    Parses a whole column of stamps that share the same format, compiling the format only once.
+    """
+    compiled = _compile_format(fmt)
+    return [compiled.parse(stamp) for stamp in stamps]
 
 
 if __name__ == "__main__":
@@ -1,19 +1,56 @@
+import bisect
+import hashlib
+import json
 import os
 import pathlib
 import re
 import shutil
-from typing import Optional, Union, List
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union, List, Dict, Iterable, Iterator, Tuple, Set
 
 import anki.collection
 import anki.decks
 import anki.notes
+from anki.collection import AddNoteRequest
 from anki.models import NotetypeDict
+from anki.utils import ids2str
 
-from utils import generate_random_file_name, compute_file_hash, get_all_from_dict_list_by_value, json_t
+from utils import generate_random_file_name, compute_file_hash, json_t
+from writer.media_index import MediaIndex
 
 _global_collections_loaded = {}
 
 
+class BulkAddReport:
+    """
+    The result of writing one batch of `AnkiWriter.bulk_add`. A batch is written as a whole or not at all - when any
+    of its records is invalid or writing it fails, none of its notes are added.
+    """
+
+    def __init__(self, batch: int, first_record: int, records: int):
+        """
+
+        :param batch: The number of the batch, starting from 0.
+        :param first_record: The number of the first record of the batch in the input, starting from 0.
+        :param records: The amount of records in the batch.
+        """
+        self.batch = batch
+        self.first_record = first_record
+        self.records = records
+        self.note_ids: List[int] = []
+        # (number of the record in the input or None for errors of the whole batch, error message)
+        self.errors: List[Tuple[Optional[int], str]] = []
+
+    @property
+    def ok(self) -> bool:
+        return len(self.errors) == 0
+
+    def __repr__(self):
+        return f"BulkAddReport(batch={self.batch}, records={self.records}, added={len(self.note_ids)}, " \
+               f"errors={self.errors})"
+
+
 class AnkiWriter:
     ANKI_EXTENSION = '.anki2'
     MODEL_FIELDS_KEY = 'flds'
@@ -22,19 +59,25 @@ class AnkiWriter:
     FIELD_NAME_KEY = 'name'
     DECK_NAME = 'name'
     MODEL_NAME = 'name'
+    NOTE_ID = 'note_id'
     DECK_PATH_TO_MEDIA_PATH = "collection.media"
 
-    SOUND_FILES = [".wav", ".mp3"]
-    IMAGE_FILES = [".jpg", ".png", ".jpeg"]
+    SOUND_FILES = [".wav", ".mp3", ".ogg", ".opus"]
+    IMAGE_FILES = [".jpg", ".png", ".jpeg", ".webp"]
     ALLOWED_FILES = SOUND_FILES + IMAGE_FILES
+    MEDIA_FILE_NAME_PATTERN = re.compile(r"([a-zA-Z0-9 ._\-]+\.[a-zA-Z0-9]{2,5})")
 
     def __init__(self, deck_path: str,
-                 deck: Union[int, str]):
+                 deck: Union[int, str],
+                 media_index_path: Optional[str] = None):
         """
 
         :param deck_path: A path to the `collection.anki2` file for the collection which will be edited.
         :param deck: A name of a deck (as a string) or the id of a deck (as an int) whose cards will be edited.
-            The cards of this deck and more relevant information will be loaded into the object for simpler editing.
+            The ids of the notes in this deck are loaded into the object, and the notes themselves are loaded when they
+            are first needed.
+        :param media_index_path: A json file to keep the index of the collection's media folder in between sessions.
+            When None is passed, the index is only kept in memory.
         """
         global _global_collections_loaded
 
@@ -44,6 +87,8 @@ class AnkiWriter:
             raise ValueError(f"file type is {os.path.splitext(deck_path)[1]} and not {self.ANKI_EXTENSION}")
 
         self.__deck_path = pathlib.Path(deck_path)
+        self._media_index_path = media_index_path
+        self._media_indexes: Dict[pathlib.Path, MediaIndex] = dict()
 
         # Can't open the same collection twice, make sure we won't
         if deck_path in _global_collections_loaded:
@@ -52,21 +97,120 @@ class AnkiWriter:
             self._collection: anki.collection.Collection = anki.collection.Collection(deck_path)
             _global_collections_loaded[deck_path] = self._collection
 
+        # Models and decks, rebuilt only when the collection's metadata changes
+        self._metadata_stamp: Optional[Tuple] = None
+        self._models_by_id: Dict[int, NotetypeDict] = dict()
+        self._models_by_name: Dict[str, List[NotetypeDict]] = dict()
+        self._model_fields: Dict[int, Tuple[List[str], Set[str]]] = dict()
+        self._decks_by_name: Dict[str, List[anki.decks.DeckDict]] = dict()
+
         # Load deck information
         self.deck_name = deck
         self._deck: Optional[anki.decks.DeckDict] = None
         if type(deck) is int:
             self._deck = self._collection.decks.get(deck)
         elif type(deck) is str:
-            all_matches = get_all_from_dict_list_by_value(self._collection.decks.all(), AnkiWriter.DECK_NAME, deck)
+            self._refresh_metadata()
+            all_matches = self._decks_by_name.get(deck, [])
             if len(all_matches) != 1:
                 raise RuntimeError(f"Invalid matches amount {len(all_matches)}")
             self._deck = self._collection.decks.get(all_matches[0]['id'])
         if self._deck is None:
             raise RuntimeError("Deck initialization failed")
 
-        self._notes: List[anki.notes.Note] = list(
-            map(self._collection.get_note, self._collection.find_notes(f"\"deck:{self._deck['name']}\"")))
+        self._note_ids: List[int] = list(self._collection.find_notes(self._deck_query()))
+        self._note_id_set = set(self._note_ids)
+        self._loaded_notes: Dict[int, anki.notes.Note] = dict()
+
+        # field -> value -> ids of the notes with that value, built for a field the first time it is searched
+        self._field_index: Dict[str, Dict[str, List[int]]] = dict()
+        # field -> all the values of the field, sorted. Used for prefix searches and dropped when values change
+        self._sorted_values: Dict[str, List[str]] = dict()
+
+    def _deck_query(self) -> str:
+        return f"\"deck:{self._deck['name']}\""
+
+    @property
+    def _notes(self) -> List[anki.notes.Note]:
+        """
+        All the notes of the deck. This loads every note, prefer `iter_notes` or `iter_field_values`.
+        """
+        return list(self.iter_notes())
+
+    def get_note(self, note_id: int) -> anki.notes.Note:
+        note = self._loaded_notes.get(note_id)
+        if note is None:
+            note = self._collection.get_note(note_id)
+            self._loaded_notes[note_id] = note
+        return note
+
+    def iter_notes(self) -> Iterator[anki.notes.Note]:
+        """
+        Goes over the notes of the deck, loading them one at a time. Notes that weren't loaded before are not kept,
+        so memory doesn't grow with the size of the deck.
+        """
+        for note_id in list(self._note_ids):
+            note = self._loaded_notes.get(note_id)
+            yield note if note is not None else self._collection.get_note(note_id)
+
+    def iter_field_values(self, fields: List[str], batch_size: int = 2000) -> Iterator[Tuple[int, Dict[str, str]]]:
+        """
+        Reads the given fields of every note of the deck straight from the database, without loading the notes.
+        :return: Pairs of a note id and the values of the requested fields that the note's model has.
+        """
+        field_positions: Dict[int, List[Tuple[str, int]]] = dict()
+        for note_id, model_id, values in self._iter_note_rows(batch_size):
+            if model_id not in field_positions:
+                model_fields, _ = self.get_model_fields(self.get_model(model_id))
+                field_positions[model_id] = [(field, model_fields.index(field))
+                                             for field in fields if field in model_fields]
+            yield note_id, {field: values[position] for field, position in field_positions[model_id]}
+
+    def _iter_note_rows(self, batch_size: int = 2000) -> Iterator[Tuple[int, int, List[str]]]:
+        """
+        :return: The id, the model id and the field values (in the order of the model) of every note of the deck,
+            read from the database in batches.
+        """
+        for i in range(0, len(self._note_ids), batch_size):
+            rows = self._collection.db.all(
+                f"select id, mid, flds from notes where id in {ids2str(self._note_ids[i:i + batch_size])}")
+            for note_id, model_id, flds in rows:
+                yield note_id, model_id, flds.split("\x1f")
+
+    def notes_signature(self) -> str:
+        """
+        :return: A value that changes whenever a note is added to the deck, removed from it or edited. Useful to
+            invalidate data derived from the notes of the deck.
+        """
+        note_ids = sorted(self._collection.find_notes(self._deck_query()))
+        last_mod = self._collection.db.scalar(f"select max(mod) from notes where id in {ids2str(note_ids)}")
+        return hashlib.sha256(f"{note_ids}:{last_mod}".encode('utf-8')).hexdigest()
+
+    def _refresh_metadata(self):
+        """
+        Rebuilds the cached models and decks if they changed since they were cached. Changes are detected through the
+        schema modification time of the collection and the modification times and counts of the models and decks, so
+        checking costs a single query no matter how many models there are.
+        """
+        stamp = tuple(self._collection.db.first(
+            "select (select scm from col), (select max(mtime_secs) from notetypes), (select count() from notetypes), "
+            "(select max(mtime_secs) from decks), (select count() from decks)"))
+        if stamp == self._metadata_stamp:
+            return
+
+        self._models_by_id = dict()
+        self._models_by_name = dict()
+        self._model_fields = dict()
+        for model in self._collection.models.all():
+            self._models_by_id[model["id"]] = model
+            self._models_by_name.setdefault(model[AnkiWriter.MODEL_NAME], []).append(model)
+        self._decks_by_name = dict()
+        for deck in self._collection.decks.all():
+            self._decks_by_name.setdefault(deck[AnkiWriter.DECK_NAME], []).append(deck)
+        if self._deck is not None:
+            # The deck might have been renamed
+            self._deck = self._collection.decks.get(self._deck[AnkiWriter.DECK_ID])
+        self._metadata_stamp = stamp
 
     def get_model(self, name_or_id: Union[str, int]) -> NotetypeDict:
         """
@@ -78,15 +222,27 @@ class AnkiWriter:
         """
         if type(name_or_id) not in [str, int]:
             raise TypeError(f"name_or_id was {type(name_or_id)} expected int or str")
+        self._refresh_metadata()
         if type(name_or_id) is int:
-            options = get_all_from_dict_list_by_value(self._collection.models.all(), "id", name_or_id)
+            options = [self._models_by_id[name_or_id]] if name_or_id in self._models_by_id else []
         else:
-            options = get_all_from_dict_list_by_value(self._collection.models.all(), "name", name_or_id)
+            options = self._models_by_name.get(name_or_id, [])
 
         if len(options) != 1:
             raise RuntimeError(f"Invalid matches amount {len(options)}")
         return options[0]
 
+    def get_model_fields(self, model: NotetypeDict) -> Tuple[List[str], Set[str]]:
+        """
+        Like `model_to_flds_list`, but the fields of every model are only extracted and validated once.
+        :return: The field names of the model, both as a list (in the order of the model) and as a set.
+        """
+        self._refresh_metadata()
+        if model["id"] not in self._model_fields:
+            fields = self.model_to_flds_list(model)
+            self._model_fields[model["id"]] = (fields, set(fields))
+        return self._model_fields[model["id"]]
+
     @staticmethod
     def model_to_flds_list(model: NotetypeDict) -> List[str]:
         """
@@ -118,6 +274,14 @@ class AnkiWriter:
             path of the data folder is interpolated from the path of the collection.
         :return: A Path object pointing to the new/existing file.
         """
+        return self._copy_media_file(file_name, collection_data_path)[0]
+
+    def _copy_media_file(self, file_name: str,
+                         collection_data_path: Optional[str] = None) -> Tuple[pathlib.Path, bool]:
+        """
+        Like `add_media_file`.
+        :return: The new/existing file, and whether it is a new file that was copied into the collection.
+        """
         if collection_data_path is None:
             collection_data_path = self.__deck_path.parent.joinpath(AnkiWriter.DECK_PATH_TO_MEDIA_PATH)
         else:
@@ -129,35 +293,63 @@ class AnkiWriter:
             raise ValueError(f"{file_name} isn't valid file")
         if os.path.splitext(file_name)[1] not in self.ALLOWED_FILES:
             print(f"file type of {file_name} not allowed.")
+        if pathlib.Path(file_name).absolute().parent == collection_data_path.absolute():
+            # Already in the collection, e.g. the path of a media file from an export
+            return collection_data_path.joinpath(os.path.basename(file_name)), False
 
+        media_index = self._get_media_index(collection_data_path)
         given_sha = compute_file_hash(file_name)
 
-        for inner in collection_data_path.iterdir():
-            # We check if the size is the same to skip most sha256 calculations
-            if inner.is_file() and os.path.getsize(file_name) == inner.stat().st_size:
-                if given_sha == compute_file_hash(inner.absolute().__str__()):
-                    print(f"Sha of {file_name} already in collection")
-                    return inner
+        existing = media_index.find(given_sha, os.path.getsize(file_name))
+        if existing is not None:
+            print(f"Sha of {file_name} already in collection")
+            return collection_data_path.joinpath(existing), False
 
-        new_name = generate_random_file_name(collection_data_path, os.path.splitext(file_name)[1])
+        # Files are named by their content, so a new name never needs to be searched for
+        new_name = collection_data_path.joinpath(given_sha[:32] + os.path.splitext(file_name)[1])
+        if new_name.exists():
+            new_name = generate_random_file_name(collection_data_path, os.path.splitext(file_name)[1])
+        dir_mtime_before = media_index.dir_mtime_ns()
         shutil.copyfile(file_name, new_name)
-        return new_name
+        media_index.add(new_name.name, given_sha, dir_mtime_before)
+        return new_name, True
+
+    def _remove_media_files(self, files: List[pathlib.Path]):
+        """
+        Deletes files that were copied into the media folder of the collection but ended up unused.
+        """
+        for file in files:
+            media_index = self._get_media_index(file.parent)
+            dir_mtime_before = media_index.dir_mtime_ns()
+            file.unlink(missing_ok=True)
+            media_index.remove(file.name, dir_mtime_before)
+
+    def _get_media_index(self, collection_data_path: pathlib.Path) -> MediaIndex:
+        if collection_data_path not in self._media_indexes:
+            default_path = self.__deck_path.parent.joinpath(AnkiWriter.DECK_PATH_TO_MEDIA_PATH)
+            # The persisted index is only for the collection's own media folder
+            index_path = self._media_index_path if collection_data_path == default_path else None
+            self._media_indexes[collection_data_path] = MediaIndex(collection_data_path, index_path)
+        return self._media_indexes[collection_data_path]
 
     def handle_file_field(self, note: anki.notes.Note, key: str, field: str):
         if not os.path.isfile(field) or os.path.islink(field):
             raise ValueError(f"{field} is not a file.")
 
-        extension = os.path.splitext(field)[-1]
-        actual_file_path = self.add_media_file(field).name
-        actual_field_val = None
+        note[key] = self._file_field_value(field, self.add_media_file(field).name)
+
+    def _file_field_value(self, file_name: str, media_name: str) -> str:
+        """
+        :param file_name: The original file, its extension decides how the file is shown.
+        :param media_name: The name of the file in the media folder of the collection.
+        :return: The field value that shows the media file.
+        """
+        extension = os.path.splitext(file_name)[-1]
         if extension in self.SOUND_FILES:
-            actual_field_val = f"[sound:{actual_file_path}]"
+            return f"[sound:{media_name}]"
         elif extension in self.IMAGE_FILES:
-            actual_field_val = f'<img src="{actual_file_path}">'
-        if actual_field_val is None:
-            raise RuntimeError("Couldn't build actual field value for file")
-
-        note[key] = actual_field_val
+            return f'<img src="{media_name}">'
+        raise RuntimeError("Couldn't build actual field value for file")
 
     def json_to_note(self, input_json: json_t, auto_handle_files: bool = True,
                      marked_as_file: List[str] = None) -> anki.notes.Note:
@@ -169,13 +361,7 @@ class AnkiWriter:
         model = self.get_model(input_json[AnkiWriter.MODEL])
         input_json.pop(AnkiWriter.MODEL)
 
-        fields = self.model_to_flds_list(model)
-        for field in fields:
-            if field not in input_json:
-                raise RuntimeError(f"{field} not in input json")
-        for key in input_json.keys():
-            if key not in fields:
-                raise RuntimeError(f"{key} from json not a valid field. Valid fields are {fields}")
+        self._validate_json_fields(input_json, *self.get_model_fields(model))
         note = anki.notes.Note(self._collection, model)
 
         for key in input_json.keys():
@@ -197,20 +383,217 @@ class AnkiWriter:
 
         self._collection.update_note(note)
 
+        self._note_ids.append(note.id)
+        self._note_id_set.add(note.id)
+        self._loaded_notes[note.id] = note
+        self._index_note(note)
+
         return note
 
+    @staticmethod
+    def _validate_json_fields(input_json: json_t, fields: List[str], field_set: Set[str]):
+        for field in fields:
+            if field not in input_json:
+                raise RuntimeError(f"{field} not in input json")
+        for key in input_json.keys():
+            if key not in field_set:
+                raise RuntimeError(f"{key} from json not a valid field. Valid fields are {fields}")
+
+    def bulk_add(self, notes_iter: Iterable[Union[json_t, str]], batch_size: int = 500,
+                 auto_handle_files: bool = True, marked_as_file: List[str] = None,
+                 media_workers: int = 4) -> List[BulkAddReport]:
+        """
+        Adds many notes to the deck. The records are read lazily and written in batches, every batch with a single
+        `add_notes` call (one database transaction), and the whole call is a single undo step.
+        :param notes_iter: The notes as dictionaries in the format of `json_to_note`, or as json strings (e.g. the
+            lines of a JSONL file). Empty strings are skipped.
+        :param batch_size: The amount of records written together.
+        :param auto_handle_files: Like in `json_to_note`.
+        :param marked_as_file: Like in `json_to_note`.
+        :param media_workers: The amount of threads copying media files into the collection.
+        :return: A report for every batch. Batches with errors aren't written, but the ones after them still are.
+        """
+        if batch_size <= 0 or media_workers <= 0:
+            raise ValueError("batch_size and media_workers must be positive")
+        if marked_as_file is None:
+            marked_as_file = []
+
+        reports = []
+        undo_target = self._collection.add_custom_undo_entry(f"Add {self._deck['name']} notes")
+        batch: List[Tuple[int, Union[json_t, str]]] = []
+        record_number = -1
+        with ThreadPoolExecutor(max_workers=media_workers) as media_pool:
+            for record_number, record in enumerate(notes_iter):
+                if isinstance(record, str) and len(record.strip()) == 0:
+                    continue
+                batch.append((record_number, record))
+                if len(batch) == batch_size:
+                    reports.append(self._bulk_add_batch(len(reports), batch, auto_handle_files, marked_as_file,
+                                                        media_pool, undo_target))
+                    batch = []
+            if len(batch) != 0:
+                reports.append(self._bulk_add_batch(len(reports), batch, auto_handle_files, marked_as_file,
+                                                    media_pool, undo_target))
+        for media_index in self._media_indexes.values():
+            media_index.save()
+        return reports
+
+    def _bulk_add_batch(self, batch_number: int, batch: List[Tuple[int, Union[json_t, str]]],
+                        auto_handle_files: bool, marked_as_file: List[str],
+                        media_pool: ThreadPoolExecutor, undo_target: int) -> BulkAddReport:
+        report = BulkAddReport(batch_number, batch[0][0], len(batch))
+
+        # Validate everything first, so nothing of an invalid batch is written (media files included)
+        records: List[Tuple[json_t, NotetypeDict, List[str]]] = []
+        media_files: Dict[str, Optional[str]] = dict()
+        for record_number, record in batch:
+            try:
+                if isinstance(record, str):
+                    record = json.loads(record)
+                if type(record) is not dict:
+                    raise ValueError(f"record is {type(record)} and not a json object")
+                if AnkiWriter.MODEL not in record or type(record[AnkiWriter.MODEL]) not in [int, str]:
+                    raise ValueError(f"json didn't include valid {AnkiWriter.MODEL} key")
+                model = self.get_model(record[AnkiWriter.MODEL])
+                values = {key: val for key, val in record.items() if key != AnkiWriter.MODEL}
+                self._validate_json_fields(values, *self.get_model_fields(model))
+                file_keys = []
+                for key, val in values.items():
+                    if type(val) is not str:
+                        raise ValueError(f"value of {key} is {type(val)} and not a string")
+                    if (auto_handle_files or (key in marked_as_file)) and os.path.isfile(val):
+                        if os.path.islink(val):
+                            raise ValueError(f"{val} is not a file.")
+                        if os.path.splitext(val)[-1] not in self.SOUND_FILES + self.IMAGE_FILES:
+                            raise ValueError(f"file type of {val} can't be shown in a field")
+                        media_files[val] = None
+                        file_keys.append(key)
+                    elif key in marked_as_file:
+                        raise RuntimeError(f"{key} should be file but wasn't")
+                records.append((values, model, file_keys))
+            except (RuntimeError, ValueError, TypeError) as e:
+                report.errors.append((record_number, str(e)))
+        if not report.ok:
+            return report
+
+        # Every file is copied once, even when it is used by multiple notes
+        paths = list(media_files.keys())
+        futures = [media_pool.submit(self._copy_media_file, path) for path in paths]
+        # Only the files this batch copied are deleted if it fails, files found in the collection stay
+        copied: List[pathlib.Path] = []
+        copy_error = None
+        for path, future in zip(paths, futures):
+            try:
+                media_path, is_new = future.result()
+            except (OSError, RuntimeError, ValueError) as e:
+                copy_error = e if copy_error is None else copy_error
+                continue
+            if is_new:
+                copied.append(media_path)
+            media_files[path] = self._file_field_value(path, media_path.name)
+        if copy_error is not None:
+            self._remove_media_files(copied)
+            report.errors.append((None, f"copying media failed: {copy_error}"))
+            return report
+
+        deck_id = self._deck.get(self.DECK_ID)
+        requests = []
+        for values, model, file_keys in records:
+            note = anki.notes.Note(self._collection, model)
+            for key, val in values.items():
+                note[key] = media_files[val] if key in file_keys else val
+            requests.append(AddNoteRequest(note, deck_id))
+
+        try:
+            self._collection.add_notes(requests)
+        except Exception as e:
+            self._remove_media_files(copied)
+            report.errors.append((None, f"adding notes failed: {e}"))
+            return report
+        note_ids = [request.note.id for request in requests]
+        try:
+            # Templates can override the deck of their cards, but every card should be in the deck
+            card_ids = self._collection.db.list(
+                f"select id from cards where nid in {ids2str(note_ids)} and did != {deck_id}")
+            if len(card_ids) != 0:
+                self._collection.set_deck(card_ids, deck_id)
+        except Exception as e:
+            self._collection.remove_notes(note_ids)
+            self._remove_media_files(copied)
+            report.errors.append((None, f"moving cards failed, batch was rolled back: {e}"))
+            return report
+        finally:
+            self._collection.merge_undo_entries(undo_target)
+
+        report.note_ids = note_ids
+        self._note_ids.extend(note_ids)
+        self._note_id_set.update(note_ids)
+        for request in requests:
+            self._index_note(request.note)
+        return report
+
+    def _get_field_index(self, field: str) -> Dict[str, List[int]]:
+        if field not in self._field_index:
+            index: Dict[str, List[int]] = dict()
+            for note_id, values in self.iter_field_values([field]):
+                if field in values:
+                    index.setdefault(values[field], []).append(note_id)
+            self._field_index[field] = index
+        return self._field_index[field]
+
+    def _index_note(self, note: anki.notes.Note, old_values: Optional[Dict[str, str]] = None):
+        """
+        Updates the indexed fields for a note that was added (or changed, in which case `old_values` holds the
+        values of the indexed fields from before the change).
+        """
+        for field, index in self._field_index.items():
+            if old_values is not None and field in old_values:
+                if old_values[field] == note[field]:
+                    continue
+                ids = index[old_values[field]]
+                ids.remove(note.id)
+                if len(ids) == 0:
+                    index.pop(old_values[field])
+            if field in note:
+                index.setdefault(note[field], []).append(note.id)
+                self._sorted_values.pop(field, None)
+
     def get_notes_by_value(self, field: str, value: str) -> List[anki.notes.Note]:
-        return list(filter(lambda a: field in a.keys() and a[field] == value, self._notes))
+        return [self.get_note(i) for i in self._get_field_index(field).get(value, [])]
+
+    def get_notes_by_values(self, field: str, values: Iterable[str]) -> Dict[str, List[anki.notes.Note]]:
+        """
+        :return: For each of the values, the notes where the field has this value.
+        """
+        index = self._get_field_index(field)
+        return {value: [self.get_note(i) for i in index.get(value, [])] for value in values}
 
-    def handle_file_fields_export(self, value: str) -> Optional[pathlib.Path]:
+    def get_notes_by_prefix(self, field: str, prefix: str) -> List[anki.notes.Note]:
+        """
+        :return: All the notes where the value of the field starts with the prefix.
+        """
+        index = self._get_field_index(field)
+        if field not in self._sorted_values:
+            self._sorted_values[field] = sorted(index.keys())
+        values = self._sorted_values[field]
+        rt = []
+        for i in range(bisect.bisect_left(values, prefix), len(values)):
+            if not values[i].startswith(prefix):
+                break
+            rt += [self.get_note(note_id) for note_id in index[values[i]]]
+        return rt
+
+    def has_value(self, field: str, value: str) -> bool:
+        return value in self._get_field_index(field)
+
+    def handle_file_fields_export(self, value: str, media_names: Optional[Set[str]] = None) -> Optional[pathlib.Path]:
         """
 
         :param value:
+        :param media_names: The names of the files in the media folder, to check against instead of the file system.
         :return: Full path to the file in the field, or None if no file in field.
         """
-        pattern = re.compile(r"([a-zA-Z0-9 ._\-]+\.[a-zA-Z0-9]{2,5})")
-
-        results = pattern.findall(value)
+        results = AnkiWriter.MEDIA_FILE_NAME_PATTERN.findall(value)
         if len(results) == 0:
             return None
         if len(results) > 1:
@@ -219,7 +602,7 @@ class AnkiWriter:
         fp = results[0]
 
         full_fp = self.__deck_path.parent.joinpath(AnkiWriter.DECK_PATH_TO_MEDIA_PATH).joinpath(fp)
-        if not full_fp.is_file():
+        if not (fp in media_names if media_names is not None else full_fp.is_file()):
             raise RuntimeError(f"File {full_fp} was found but wasn't a file")
 
         return full_fp
@@ -229,7 +612,13 @@ class AnkiWriter:
                                     auto_handle_files: bool = True,
                                     marked_as_file: List[str] = None,
                                     marked_as_not_files: List[str] = None,
-                                    all_non_file: bool = False):
+                                    all_non_file: bool = False,
+                                    write: bool = True):
+        """
+        Overwrites the fields of the note with the values from the json.
+        :param write: When False, only the note object is changed and the caller must write it into the collection
+            (e.g. with `update_notes` for many notes at once).
+        """
         target_model = note.note_type()[self.MODEL_NAME]
         if target_model != input_json[self.MODEL]:
             raise RuntimeError(
@@ -250,6 +639,8 @@ class AnkiWriter:
             if field in marked_as_not_files:
                 raise RuntimeError(f"{field} was marked as both file and not file")
 
+        old_values = {field: note[field] for field in self._field_index if field in note}
+
         for key, value in input_json.items():
             if ((auto_handle_files or (key in marked_as_file))
                     and os.path.isfile(value) and key not in marked_as_not_files) and not all_non_file:
@@ -259,17 +650,117 @@ class AnkiWriter:
                     raise RuntimeError(f"{key} should be file but wasn't")
                 note[key] = value
 
-        cards = note.cards()
-        for card in cards:
-            self._collection.update_card(card)
+        if write:
+            cards = note.cards()
+            for card in cards:
+                self._collection.update_card(card)
 
-        self._collection.update_note(note)
+            self._collection.update_note(note)
+            # The note may be another instance than the cached one (e.g. from `iter_notes`), which is now stale
+            if note.id in self._loaded_notes:
+                self._loaded_notes[note.id] = note
+
+        if note.id in self._note_id_set:
+            self._index_note(note, old_values)
+
+    def import_jsonl(self, jsonl_path: str, batch_size: int = 500,
+                     auto_handle_files: bool = True,
+                     marked_as_file: List[str] = None,
+                     marked_as_not_files: List[str] = None,
+                     all_non_file: bool = False) -> int:
+        """
+        Updates notes of the deck from a file written by `export_deck_to_jsonl`, reading it line by line. Every
+        record must have the id of the note it updates. The notes are written in batches with a single
+        `update_notes` call, and the whole import is a single undo step.
+        :return: The amount of notes updated.
+        """
+        if batch_size <= 0:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+        undo_target = self._collection.add_custom_undo_entry(f"Import {self._deck['name']} notes")
+        updated = 0
+        batch: List[anki.notes.Note] = []
+        with open(jsonl_path, "r", encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                if len(line.strip()) == 0:
+                    continue
+                record = json.loads(line)
+                if type(record) is not dict or type(record.get(self.NOTE_ID)) is not int:
+                    raise RuntimeError(f"line {line_number} of {jsonl_path} has no valid {self.NOTE_ID}")
+                note_id = record.pop(self.NOTE_ID)
+                if note_id not in self._note_id_set:
+                    raise RuntimeError(f"note {note_id} from line {line_number} is not in the deck")
+                note = self._collection.get_note(note_id)
+                self.update_note_values_via_json(note, record, auto_handle_files, marked_as_file,
+                                                 marked_as_not_files, all_non_file, write=False)
+                batch.append(note)
+                if len(batch) == batch_size:
+                    updated += self._write_notes(batch, undo_target)
+                    batch = []
+        if len(batch) != 0:
+            updated += self._write_notes(batch, undo_target)
+        return updated
+
+    def _write_notes(self, notes: List[anki.notes.Note], undo_target: int) -> int:
+        self._collection.update_notes(notes)
+        self._collection.merge_undo_entries(undo_target)
+        for note in notes:
+            if note.id in self._loaded_notes:
+                self._loaded_notes[note.id] = note
+        return len(notes)
+
+    def export_deck_to_jsonl(self, jsonl_path: str, media_tar_path: Optional[str] = None,
+                             marked_as_file: List[str] = None,
+                             marked_as_not_files: List[str] = None,
+                             all_non_files: bool = False,
+                             batch_size: int = 2000) -> int:
+        """
+        Writes every note of the deck as a line of json, in the format of `export_note_into_json` with the id of the
+        note under `NOTE_ID`. Notes are read from the database in batches, so memory doesn't grow with the deck.
+        :param media_tar_path: When given, every media file the notes refer to is also written into a tar file.
+        :return: The amount of notes written.
+        """
+        media_names = self._get_media_index(
+            self.__deck_path.parent.joinpath(AnkiWriter.DECK_PATH_TO_MEDIA_PATH)).names()
+        tar = tarfile.open(media_tar_path, "w") if media_tar_path is not None else None
+        archived: Set[str] = set()
+        written = 0
+        try:
+            with open(jsonl_path, "w", encoding='utf-8') as f:
+                for note_id, model_id, values in self._iter_note_rows(batch_size):
+                    model = self.get_model(model_id)
+                    fields, _ = self.get_model_fields(model)
+                    rt_json = self._values_to_json(model[self.MODEL_NAME], zip(fields, values), marked_as_file,
+                                                   marked_as_not_files, all_non_files, media_names)
+                    rt_json[self.NOTE_ID] = note_id
+                    f.write(json.dumps(rt_json, ensure_ascii=False) + "\n")
+                    written += 1
+
+                    # Exactly the fields marked as files hold files, anything else would have failed the export
+                    if tar is not None and not all_non_files:
+                        for field in marked_as_file or []:
+                            path = pathlib.Path(rt_json[field])
+                            if path.name not in archived:
+                                tar.add(str(path), arcname=path.name)
+                                archived.add(path.name)
+        finally:
+            if tar is not None:
+                tar.close()
+        return written
 
     def export_note_into_json(self, note: anki.notes.Note,
                               marked_as_file: List[str] = None,
                               marked_as_not_files: List[str] = None,
                               all_non_files: bool=False) -> json_t:
-        rt_json = {self.MODEL: note.note_type()[self.MODEL_NAME]}
+        return self._values_to_json(note.note_type()[self.MODEL_NAME], note.items(), marked_as_file,
+                                    marked_as_not_files, all_non_files)
+
+    def _values_to_json(self, model_name: str, items: Iterable[Tuple[str, str]],
+                        marked_as_file: List[str] = None,
+                        marked_as_not_files: List[str] = None,
+                        all_non_files: bool = False,
+                        media_names: Optional[Set[str]] = None) -> json_t:
+        rt_json = {self.MODEL: model_name}
 
         if marked_as_file is None:
             marked_as_file = []
@@ -284,12 +775,11 @@ class AnkiWriter:
             if field in marked_as_not_files:
                 raise RuntimeError(f"{field} was marked as both file and not file")
 
-        for field in note.keys():
-            value = note[field]
+        for field, value in items:
             if field in marked_as_not_files or all_non_files:
                 rt_json[field] = value
                 continue
-            as_path = self.handle_file_fields_export(value)
+            as_path = self.handle_file_fields_export(value, media_names)
             if as_path is None and field in marked_as_file:
                 raise RuntimeError(f"{field} should be a file but wasn't")
             if as_path is not None and field not in marked_as_file:
@@ -0,0 +1,211 @@
+import atexit
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from utils import compute_file_hash
+
+
+class MediaIndex:
+    """
+    An index of the files in a media folder by size and sha256, so finding whether a file is already in the folder
+    doesn't need to go over (and hash) the whole folder.
+
+    The folder is only listed again when its mtime changed, and only files whose size or mtime changed lose their
+    known hash. Files are also checked again before they are returned, since editing a file in place doesn't change
+    the mtime of the folder. Hashes are computed lazily - only for files with the same size as a file that is looked
+    up.
+    """
+
+    def __init__(self, media_dir: pathlib.Path, index_path: Optional[str] = None, save_interval: float = 30.0):
+        """
+
+        :param media_dir: The media folder to index.
+        :param index_path: A json file to keep the index in between sessions. When None is passed, the index is only
+            kept in memory.
+        :param save_interval: Changes are written to the json file at most once in this many seconds, and when the
+            program exits.
+        """
+        if not media_dir.is_dir():
+            raise ValueError(f"{media_dir} is not a directory")
+        self.media_dir = media_dir
+        self.index_path = index_path
+        self.save_interval = save_interval
+        self._dirty = False
+        self._last_save = time.monotonic()
+        # name -> [size, mtime_ns, sha256 or None]
+        self._files: Dict[str, List] = dict()
+        self._by_size: Dict[int, List[str]] = dict()
+        self._dir_mtime_ns: Optional[int] = None
+        self._lock = threading.Lock()
+        self._load()
+        if self.index_path is not None:
+            atexit.register(self.save)
+
+    def _load(self):
+        if self.index_path is None or not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+            if data["media_dir"] != str(self.media_dir.absolute()):
+                return
+            self._files = data["files"]
+            self._dir_mtime_ns = data["dir_mtime_ns"]
+        except (OSError, ValueError, KeyError):
+            self._files = dict()
+            self._dir_mtime_ns = None
+        self._rebuild_sizes()
+
+    def save(self):
+        """
+        Writes the index to its json file if it changed since it was last written.
+        """
+        if self.index_path is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {"media_dir": str(self.media_dir.absolute()),
+                    "dir_mtime_ns": self._dir_mtime_ns,
+                    "files": self._files}
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def _save_if_due(self):
+        # Writing the whole index on every change would cost more than the lookups it saves
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def _rebuild_sizes(self):
+        self._by_size = dict()
+        for name, (size, _, _) in self._files.items():
+            self._by_size.setdefault(size, []).append(name)
+
+    def refresh(self) -> bool:
+        """
+        Lists the folder again if it changed since the last time.
+        :return: Whether the folder was listed.
+        """
+        with self._lock:
+            dir_mtime_ns = self.media_dir.stat().st_mtime_ns
+            if dir_mtime_ns == self._dir_mtime_ns:
+                return False
+
+            files = dict()
+            with os.scandir(self.media_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    known = self._files.get(entry.name)
+                    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                        files[entry.name] = known
+                    else:
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns, None]
+            self._files = files
+            self._dir_mtime_ns = dir_mtime_ns
+            self._rebuild_sizes()
+            self._dirty = True
+        self._save_if_due()
+        return True
+
+    def names(self) -> Set[str]:
+        """
+        :return: The names of all the files in the folder.
+        """
+        self.refresh()
+        with self._lock:
+            return set(self._files.keys())
+
+    def find(self, sha: str, size: int) -> Optional[str]:
+        """
+        :return: The name of a file in the folder with the given content hash and size, or None if there is none.
+        """
+        self.refresh()
+        found = None
+        with self._lock:
+            for name in list(self._by_size.get(size, [])):
+                if not self._check_file(name) or self._files[name][0] != size:
+                    continue
+                entry = self._files[name]
+                if entry[2] is None:
+                    entry[2] = compute_file_hash(str(self.media_dir.joinpath(name)))
+                    self._dirty = True
+                if entry[2] == sha:
+                    found = name
+                    break
+        self._save_if_due()
+        return found
+
+    def _check_file(self, name: str) -> bool:
+        """
+        Stats a known file again while holding the lock, forgetting its hash if its size or mtime changed.
+        :return: Whether the file still exists.
+        """
+        entry = self._files[name]
+        try:
+            stat = self.media_dir.joinpath(name).stat()
+        except FileNotFoundError:
+            self._files.pop(name)
+            self._by_size[entry[0]].remove(name)
+            self._dirty = True
+            return False
+        if entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            self._by_size[entry[0]].remove(name)
+            self._files[name] = [stat.st_size, stat.st_mtime_ns, None]
+            self._by_size.setdefault(stat.st_size, []).append(name)
+            self._dirty = True
+        return True
+
+    def dir_mtime_ns(self) -> int:
+        """
+        :return: The current mtime of the folder, to pass to `add` or `remove` when taken just before the change.
+        """
+        return self.media_dir.stat().st_mtime_ns
+
+    def _advance_dir_mtime(self, dir_mtime_before: Optional[int]):
+        """
+        Called while holding the lock after recording a change made by this process. The change itself modified the
+        folder's mtime, which doesn't need another listing - but only if the index was up to date right before it.
+        Otherwise other changes (e.g. files added by Anki) would be marked as seen, and stay out of the index.
+        """
+        if dir_mtime_before is not None and dir_mtime_before == self._dir_mtime_ns:
+            self._dir_mtime_ns = self.dir_mtime_ns()
+
+    def add(self, name: str, sha: Optional[str] = None, dir_mtime_before: Optional[int] = None):
+        """
+        Records a file that was just put into the folder.
+        :param dir_mtime_before: The mtime of the folder from right before the file was put into it. When None is
+            passed, the folder is listed again by the next `refresh`.
+        """
+        stat = self.media_dir.joinpath(name).stat()
+        with self._lock:
+            old = self._files.get(name)
+            if old is not None:
+                self._by_size[old[0]].remove(name)
+            self._files[name] = [stat.st_size, stat.st_mtime_ns, sha]
+            self._by_size.setdefault(stat.st_size, []).append(name)
+            self._advance_dir_mtime(dir_mtime_before)
+            self._dirty = True
+        self._save_if_due()
+
+    def remove(self, name: str, dir_mtime_before: Optional[int] = None):
+        """
+        Records a file that was just deleted from the folder.
+        :param dir_mtime_before: Like in `add`.
+        """
+        with self._lock:
+            old = self._files.pop(name, None)
+            if old is not None:
+                self._by_size[old[0]].remove(name)
+            self._advance_dir_mtime(dir_mtime_before)
+            self._dirty = True
+        self._save_if_due()